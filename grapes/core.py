@@ -5,12 +5,17 @@ Author: Giulio Foletto <giulio.foletto@outlook.com>.
 License: See project-level license file.
 """
 
+import collections
+import concurrent.futures
+import contextlib
 import copy
+import dataclasses
 import inspect
+import sys
 
 import networkx as nx
 
-from . import function_composer
+from . import function_compiler, function_composer
 
 starting_node_properties = {
     "type": "standard",
@@ -23,6 +28,104 @@ starting_node_properties = {
     "reachability": None,
 }
 
+# Reachabilities are ordered from worst to best, so that they can be combined with min and max
+reachability_ranks = {"unreachable": 0, "uncertain": 1, "reachable": 2}
+
+
+def intern_name(name):
+    """
+    Intern node names that are plain strings, so that equal names share one object and dict lookups can compare by identity.
+    Other hashables are returned unchanged.
+    """
+    if type(name) is str:
+        return sys.intern(name)
+    return name
+
+
+def trivial_recipe(x):
+    """
+    Identity function, used as recipe of conditionals converted to trivial steps.
+    Defined at module level so that all trivial steps share it and it can be pickled.
+    """
+    return x
+
+
+def build_callers(arguments):
+    """
+    Build the callers of recipes from a map from nodes to tuples (recipe, args, kwargs), as stored in a FrozenPlan.
+    Recipes with keywords that are not identifiers get no caller, and must be called generically.
+    """
+    callers = {}
+    for node, (recipe, args, kwargs) in arguments.items():
+        caller = function_compiler.get_caller(
+            len(args), tuple(key for key, value in kwargs)
+        )
+        if caller is not None:
+            callers[node] = (caller, args + tuple(value for key, value in kwargs))
+    return callers
+
+
+@dataclasses.dataclass(frozen=True)
+class FrozenPlan:
+    """
+    Immutable snapshot of the structure of a graph, used for fast traversal.
+
+    It is built from the nx_digraph when needed and discarded whenever the structure of the graph changes.
+    """
+
+    # Avoid a per-instance __dict__
+    __slots__ = (
+        "order",
+        "generations",
+        "predecessors",
+        "successors",
+        "arguments",
+        "callers",
+        "sources",
+        "sinks",
+        "conditionals",
+    )
+
+    # Nodes in topological order, i.e., from dependencies to targets
+    order: tuple
+    # Topological generations, each one a tuple of nodes
+    generations: tuple
+    # Map from each node to the tuple of its predecessors (in the order of the nx_digraph)
+    predecessors: dict
+    # Map from each node to the tuple of its successors (in the order of the nx_digraph)
+    successors: dict
+    # Map from each node with a recipe to the tuple (recipe, args, kwargs), where kwargs is a tuple of (key, node) pairs
+    arguments: dict
+    # Map from each node with a recipe to the tuple (caller, names), used to call the recipe as caller(func, get, *names)
+    callers: dict
+    # Nodes without predecessors
+    sources: tuple
+    # Nodes without successors
+    sinks: tuple
+    # Conditional nodes
+    conditionals: tuple
+
+    def __getstate__(self):
+        # Callers are generated code, which cannot be pickled, so they are rebuilt when unpickling
+        return tuple(
+            getattr(self, name) if name != "callers" else None
+            for name in self.__slots__
+        )
+
+    def __setstate__(self, state):
+        # Bypass the frozen __setattr__, as __init__ does
+        for name, value in zip(self.__slots__, state):
+            object.__setattr__(self, name, value)
+        object.__setattr__(self, "callers", build_callers(self.arguments))
+
+    def __copy__(self):
+        # Immutable, so copies can share it
+        return self
+
+    def __deepcopy__(self, memo):
+        # Immutable, so copies can share it
+        return self
+
 
 class Graph:
     """
@@ -37,6 +140,43 @@ class Graph:
             self._nxdg = nx_digraph
         # Alias for easy access
         self.nodes = self._nxdg.nodes
+        # Frozen plan of the structure, built lazily
+        self._plan = None
+        # Fingerprint of the structure, built lazily
+        self._fingerprint = None
+        # Whether the structure changed since the last finalization
+        self._definition_dirty = True
+        # Cache of the functions held by recipe nodes, dropped when their values change
+        self._recipe_functions = {}
+        # Cache of the ancestors of nodes, dropped when the structure changes
+        self._ancestors = {}
+        # Ancestors of nodes as bitmasks over the topological order, built lazily for the nodes that are queried
+        self._ancestor_masks = {}
+        # Map from each node to its index in the topological order, built lazily
+        self._order_indexes = None
+
+    def copy(self):
+        """
+        Get a copy of the graph, faster than copy.deepcopy because values are not copied.
+
+        Node attributes are copied, so values and structure can be changed independently in the two graphs,
+        but the copy holds the same value objects as the original.
+        The frozen plan is shared until one of the two graphs changes its structure.
+        """
+        other = self.__class__(self._nxdg.copy())
+        # Containers in node attributes may be modified in place, e.g., by simplify_dependency, so they are copied too
+        for attributes in other.nodes.values():
+            for key in ("kwargs", "conditions", "possibilities"):
+                if key in attributes:
+                    attributes[key] = copy.copy(attributes[key])
+        other._plan = self._plan
+        other._fingerprint = self._fingerprint
+        other._definition_dirty = self._definition_dirty
+        other._recipe_functions = dict(self._recipe_functions)
+        other._ancestors = dict(self._ancestors)
+        other._ancestor_masks = dict(self._ancestor_masks)
+        other._order_indexes = self._order_indexes
+        return other
 
     def __getitem__(self, node):
         """
@@ -54,14 +194,25 @@ class Graph:
         """
         Equality check based on all members.
         """
-        return isinstance(other, self.__class__) and nx.is_isomorphic(
-            self._nxdg, other._nxdg, dict.__eq__, dict.__eq__
-        )
+        if not isinstance(other, self.__class__):
+            return False
+        # Graphs with different fingerprints cannot be isomorphic, so skip the full check
+        if self._get_fingerprint() != other._get_fingerprint():
+            return False
+        # The same holds for some node attributes, which can change without structural changes
+        if self._get_attribute_summary() != other._get_attribute_summary():
+            return False
+        return nx.is_isomorphic(self._nxdg, other._nxdg, dict.__eq__, dict.__eq__)
 
     def add_step(self, name, recipe=None, *args, **kwargs):
         """
         Interface to add a node to the graph, with all its dependencies.
         """
+        self._invalidate_plan()
+        name = intern_name(name)
+        recipe = intern_name(recipe)
+        args = tuple(intern_name(arg) for arg in args)
+        kwargs = {key: intern_name(value) for key, value in kwargs.items()}
         # Check that if a node has dependencies, it also has a recipe
         if recipe is None and (len(args) > 0 or len(kwargs.keys()) > 0):
             raise ValueError("Cannot add node with dependencies without a recipe")
@@ -106,6 +257,58 @@ class Graph:
                     self._nxdg.add_node(value, **starting_node_properties)
                 self._nxdg.add_edge(value, name)
 
+    def add_steps(self, steps):
+        """
+        Interface to add many steps at once.
+
+        The result is the same as calling add_step for each step, but nodes and edges are inserted in bulk.
+        If a step is invalid, the graph is left unchanged.
+
+        Parameters
+        ----------
+        steps: iterable of tuples
+            Each tuple is (name, recipe, *args), optionally followed by a dict of kwargs, as in add_step
+        """
+        # Collect new nodes (in a dict, to keep insertion order), edges and definitions, in the order of add_step
+        new_nodes = {}
+        edges = []
+        definitions = []
+        for step in steps:
+            if len(step) > 2 and isinstance(step[-1], dict):
+                kwargs = step[-1]
+                step = step[:-1]
+            else:
+                kwargs = {}
+            name = intern_name(step[0])
+            recipe = intern_name(step[1]) if len(step) > 1 else None
+            args = tuple(intern_name(arg) for arg in step[2:])
+            kwargs = {key: intern_name(value) for key, value in kwargs.items()}
+            # Check that if a node has dependencies, it also has a recipe
+            if recipe is None and (len(args) > 0 or len(kwargs) > 0):
+                raise ValueError("Cannot add node with dependencies without a recipe")
+            if recipe is None:
+                nodes = (name,)
+            else:
+                nodes = (name, recipe) + args + tuple(kwargs.values())
+                edges.append((recipe, name))
+                edges.extend((arg, name) for arg in args)
+                edges.extend((value, name) for value in kwargs.values())
+                definitions.append((name, recipe, args, kwargs))
+            for node in nodes:
+                # Avoid adding existing nodes so as not to overwrite attributes
+                if node not in self.nodes:
+                    new_nodes[node] = None
+
+        self._invalidate_plan()
+        self._nxdg.add_nodes_from(new_nodes, **starting_node_properties)
+        self._nxdg.add_edges_from(edges)
+        for name, recipe, args, kwargs in definitions:
+            attributes = self.nodes[name]
+            attributes["recipe"] = recipe
+            attributes["args"] = args
+            attributes["kwargs"] = kwargs
+            self.nodes[recipe]["is_recipe"] = True
+
     def add_step_quick(self, name, recipe):
         """
         Interface to quickly add a step by passing a name and a function.
@@ -118,7 +321,7 @@ class Graph:
             raise TypeError(
                 "The passed recipe should be a function, but it is a " + type(recipe)
             )
-        argspec = inspect.getfullargspec(recipe)
+        argspec = function_composer.get_argspec(recipe)
         # varargs and varkw are not supported because add_step_quick needs parameter names to build nodes
         if argspec.varargs is not None or argspec.varkw is not None:
             raise ValueError(
@@ -151,6 +354,10 @@ class Graph:
         """
         Interface to add a multiple conditional to the graph.
         """
+        self._invalidate_plan()
+        name = intern_name(name)
+        conditions = [intern_name(condition) for condition in conditions]
+        possibilities = [intern_name(possibility) for possibility in possibilities]
         # Add all nodes and connect all edges
         # Avoid adding existing node so as not to overwrite attributes
         if name not in self.nodes:
@@ -177,6 +384,17 @@ class Graph:
         if name not in self.nodes:
             raise ValueError("Cannot edit non-existent node " + name)
 
+        # Editing a step into itself changes nothing, so keep the plan and the caches that depend on it
+        attributes = self.nodes[name]
+        if (
+            attributes["type"] == "standard"
+            and recipe is not None
+            and attributes.get("recipe") == recipe
+            and attributes.get("args") == args
+            and attributes.get("kwargs") == kwargs
+        ):
+            return
+
         # Store old attributes
         was_recipe = self.is_recipe(name)
         was_frozen = self.is_frozen(name)
@@ -184,6 +402,7 @@ class Graph:
         if had_value:
             old_value = self.get_value(name)
 
+        self._invalidate_plan()
         # Remove in-edges from the node because we need to replace them
         # use of list() is to make a copy because in_edges() returns a view
         self._nxdg.remove_edges_from(list(self._nxdg.in_edges(name)))
@@ -203,8 +422,13 @@ class Graph:
         Interface to remove an existing node, without changing anything else
         """
         if name not in self.nodes:
-            raise ValueError("Cannot edit non-existent node " + name)
+            raise ValueError("Cannot remove non-existent node " + name)
+        plan = self._plan
+        self._invalidate_plan()
         self._nxdg.remove_node(name)
+        # Patch the existing plan rather than building a new one from the nx_digraph
+        if plan is not None:
+            self._plan = self._remove_from_plan(plan, name)
 
     def get_node_attribute(self, node, attribute):
         attributes = self.nodes[node]
@@ -213,7 +437,34 @@ class Graph:
         else:
             raise ValueError("Node " + node + " has no " + attribute)
 
+    def get_node_attributes(self, nodes, attribute):
+        """
+        Get an attribute of multiple nodes as dictionary.
+
+        Parameters
+        ----------
+        nodes: list of hashables (typically strings)
+            List of names of nodes whose attribute is required
+        attribute: str
+            Name of the attribute
+
+        Returns
+        -------
+        dict
+            Dictionary whose keys are the elements of nodes and whose values are the corresponding attribute values
+        """
+        graph_nodes = self.nodes
+        result = {}
+        for node in nodes:
+            value = graph_nodes[node].get(attribute)
+            if value is None:
+                raise ValueError("Node " + node + " has no " + attribute)
+            result[node] = value
+        return result
+
     def set_node_attribute(self, node, attribute, value):
+        if attribute in ("value", "has_value"):
+            self._recipe_functions.pop(node, None)
         self.nodes[node][attribute] = value
 
     def is_recipe(self, node):
@@ -226,18 +477,21 @@ class Graph:
         return self.get_node_attribute(node, "recipe")
 
     def set_recipe(self, node, recipe):
+        self._invalidate_plan()
         return self.set_node_attribute(node, "recipe", recipe)
 
     def get_args(self, node):
         return self.get_node_attribute(node, "args")
 
     def set_args(self, node, args):
+        self._invalidate_plan()
         return self.set_node_attribute(node, "args", args)
 
     def get_kwargs(self, node):
         return self.get_node_attribute(node, "kwargs")
 
     def set_kwargs(self, node, kwargs):
+        self._invalidate_plan()
         return self.set_node_attribute(node, "kwargs", kwargs)
 
     def get_conditions(self, node):
@@ -266,6 +520,7 @@ class Graph:
         return self.get_node_attribute(node, "type")
 
     def set_type(self, node, type):
+        self._invalidate_plan()
         return self.set_node_attribute(node, "type", type)
 
     def get_topological_generation_index(self, node):
@@ -287,13 +542,26 @@ class Graph:
 
     def set_value(self, node, value):
         # Note: This changes reachability
+        self._recipe_functions.pop(node, None)
         self.nodes[node]["value"] = value
         self.nodes[node]["has_value"] = True
 
     def unset_value(self, node):
         # Note: This changes reachability
+        self._recipe_functions.pop(node, None)
         self.nodes[node]["has_value"] = False
 
+    def _get_recipe_function(self, recipe):
+        """
+        Get the function held by a recipe node, caching it until the value of the node changes.
+        """
+        try:
+            return self._recipe_functions[recipe]
+        except KeyError:
+            func = self.get_value(recipe)
+            self._recipe_functions[recipe] = func
+            return func
+
     def get_reachability(self, node):
         attributes = self.nodes[node]
         if (
@@ -326,19 +594,52 @@ class Graph:
     def set_has_value(self, node, has_value):
         return self.set_node_attribute(node, "has_value", has_value)
 
-    def clear_values(self, *args):
+    def clear_values(self, *args, include_descendants=False):
         """
         Clear values in the graph nodes.
+
+        Parameters
+        ----------
+        args: hashables (typically strings)
+            Names of the nodes to clear. If none is passed, all nodes are cleared
+        include_descendants: bool
+            Whether to also clear all nodes that depend on the passed ones (default: False).
+            This is useful after changing some inputs, so that only the affected nodes are recomputed.
+            Frozen nodes keep their values and shield their descendants.
         """
         if len(args) == 0:  # Interpret as "Clear everything"
             nodes_to_clear = self.nodes
         else:
             nodes_to_clear = args & self.nodes  # Intersection
+            if include_descendants:
+                nodes_to_clear = self._get_unfrozen_descendants(nodes_to_clear)
 
+        # Work on the attribute dicts directly, as this is called after every execution of wrapped graphs
+        recipe_functions = self._recipe_functions
         for node in nodes_to_clear:
-            if self.is_frozen(node):
+            attributes = self.nodes[node]
+            if attributes["is_frozen"]:
                 continue
-            self.unset_value(node)
+            attributes["has_value"] = False
+            recipe_functions.pop(node, None)
+
+    def _get_unfrozen_descendants(self, nodes):
+        """
+        Get the passed nodes and their descendants, without walking past frozen nodes.
+        """
+        successors = self._get_plan().successors
+        descendants = set(nodes)
+        to_visit = list(nodes)
+        while len(to_visit) > 0:
+            node = to_visit.pop()
+            for successor in successors[node]:
+                if (
+                    successor not in descendants
+                    and not self.nodes[successor]["is_frozen"]
+                ):
+                    descendants.add(successor)
+                    to_visit.append(successor)
+        return descendants
 
     def has_reachability(self, node):
         return self.get_node_attribute(node, "has_reachability")
@@ -346,14 +647,25 @@ class Graph:
     def set_has_reachability(self, node, has_reachability):
         return self.set_node_attribute(node, "has_reachability", has_reachability)
 
-    def clear_reachabilities(self, *args):
+    def clear_reachabilities(self, *args, include_descendants=False):
         """
         Clear reachabilities in the graph nodes.
+
+        Parameters
+        ----------
+        args: hashables (typically strings)
+            Names of the nodes to clear. If none is passed, all nodes are cleared
+        include_descendants: bool
+            Whether to also clear all nodes that depend on the passed ones (default: False).
+            This is useful after changing some values, so that only the affected reachabilities are found again.
+            Frozen nodes keep their reachabilities and shield their descendants.
         """
         if len(args) == 0:  # Interpret as "Clear everything"
             nodes_to_clear = self.nodes
         else:
             nodes_to_clear = args & self.nodes  # Intersection
+            if include_descendants:
+                nodes_to_clear = self._get_unfrozen_descendants(nodes_to_clear)
 
         for node in nodes_to_clear:
             if self.is_frozen(node):
@@ -369,10 +681,16 @@ class Graph:
         dictionary: dict
             Dictionary with the new values
         """
+        # Same as set_value for each key, but with the attribute dicts and the cache looked up once
+        nodes = self.nodes
+        recipe_functions = self._recipe_functions
         for key, value in dictionary.items():
             # Accept dictionaries with more keys than needed
-            if key in self.nodes:
-                self.set_value(key, value)
+            if key in nodes:
+                recipe_functions.pop(key, None)
+                attributes = nodes[key]
+                attributes["value"] = value
+                attributes["has_value"] = True
 
     def set_internal_context(self, dictionary):
         """
@@ -420,10 +738,8 @@ class Graph:
         list
             List like list_of_keys which contains values of nodes
         """
-        res = []
-        for key in list_of_keys:
-            res.append(self.get_value(key))
-        return res
+        # map runs the loop in C
+        return list(map(self.get_value, list_of_keys))
 
     def get_dict_of_values(self, list_of_keys):
         """
@@ -439,7 +755,9 @@ class Graph:
         dict
             Dictionary whose keys are the elements of list_of_keys and whose values are the corresponding node values
         """
-        return {key: self.get_value(key) for key in list_of_keys}
+        # Iterate over keys only once, in case they are given as an iterator
+        list_of_keys = list(list_of_keys)
+        return dict(zip(list_of_keys, map(self.get_value, list_of_keys)))
 
     def get_kwargs_values(self, dictionary):
         """
@@ -455,46 +773,106 @@ class Graph:
         dict
             A dict with the same keys of the input dictionary, but with values replaced by the values of the nodes
         """
-        return {key: self.get_value(value) for key, value in dictionary.items()}
+        return dict(zip(dictionary.keys(), map(self.get_value, dictionary.values())))
 
-    def evaluate_target(self, target, continue_on_fail=False):
+    def evaluate_target(self, target, continue_on_fail=False, failed_nodes=None):
         """
         Generic interface to evaluate a GenericNode.
+
+        If failed_nodes is a set, nodes whose evaluation fails are added to it and are not retried.
         """
-        if self.get_type(target) == "standard":
-            return self.evaluate_standard(target, continue_on_fail)
-        elif self.get_type(target) == "conditional":
-            return self.evaluate_conditional(target, continue_on_fail)
+        type = self.get_type(target)
+        if type == "standard":
+            return self.evaluate_standard(target, continue_on_fail, failed_nodes)
+        elif type == "conditional":
+            return self.evaluate_conditional(target, continue_on_fail, failed_nodes)
         else:
             raise ValueError(
-                "Evaluation of nodes of type "
-                + self.get_type(target)
-                + " is not supported"
+                "Evaluation of nodes of type " + type + " is not supported"
             )
 
-    def evaluate_standard(self, node, continue_on_fail=False):
+    def evaluate_standard(self, node, continue_on_fail=False, failed_nodes=None):
         """
         Evaluate of a node.
+
+        Dependencies are visited depth-first with an explicit stack rather than by recursion, so that long chains of steps do not hit the recursion limit.
+        """
+        plan = self._get_plan()
+        nodes = self.nodes
+        # Each frame holds a node, the index of its next dependency to visit and whether its visited dependencies have values
+        stack = [[node, 0, True]]
+        while len(stack) > 0:
+            frame = stack[-1]
+            current, index, ready = frame
+            predecessors = plan.predecessors[current]
+            if index == 0:
+                # Check if it already has a value
+                if self.has_value(current):
+                    self.get_value(current)
+                    stack.pop()
+                    continue
+                # Check if it already failed
+                if failed_nodes is not None and current in failed_nodes:
+                    stack.pop()
+                    continue
+            elif not nodes[predecessors[index - 1]]["has_value"]:
+                # Back from a dependency that could not be computed
+                ready = False
+            # If not, evaluate all arguments
+            while index < len(predecessors):
+                dependency_name = predecessors[index]
+                index += 1
+                # Skip dependencies that already have a value, which is the most common case
+                attributes = nodes[dependency_name]
+                if attributes["has_value"] and attributes["value"] is not None:
+                    continue
+                if self.get_type(dependency_name) == "standard":
+                    break
+                self.evaluate_target(dependency_name, continue_on_fail, failed_nodes)
+                if not attributes["has_value"]:
+                    ready = False
+            else:
+                stack.pop()
+                self._compute_standard(
+                    current, ready, plan, continue_on_fail, failed_nodes
+                )
+                continue
+            # Visit the standard dependency before coming back to this node
+            frame[1] = index
+            frame[2] = ready
+            stack.append([dependency_name, 0, True])
+
+    def _compute_standard(self, node, ready, plan, continue_on_fail, failed_nodes):
         """
-        # Check if it already has a value
-        if self.has_value(node):
-            self.get_value(node)
+        Compute the value of a standard node whose dependencies have been evaluated.
+        """
+        # When failures are expected, skip nodes that cannot be computed rather than raising and catching an exception
+        if continue_on_fail and (not ready or node not in plan.arguments):
+            if failed_nodes is not None:
+                failed_nodes.add(node)
             return
-        # If not, evaluate all arguments
-        for dependency_name in self._nxdg.predecessors(node):
-            self.evaluate_target(dependency_name, continue_on_fail)
 
         # Actual computation happens here
         try:
-            recipe = self.get_recipe(node)
-            func = self.get_value(recipe)
-            res = func(
-                *self.get_list_of_values(self.get_args(node)),
-                **self.get_kwargs_values(self.get_kwargs(node))
-            )
+            arguments = plan.arguments.get(node)
+            if arguments is None:
+                # Raises the appropriate error
+                self.get_recipe(node)
+            recipe, args, kwargs = arguments
+            func = self._get_recipe_function(recipe)
+            caller = plan.callers.get(node)
+            if caller is not None:
+                res = caller[0](func, self.get_value, *caller[1])
+            else:
+                res = func(
+                    *[self.get_value(arg) for arg in args],
+                    **{key: self.get_value(value) for key, value in kwargs}
+                )
         except Exception as e:
             if continue_on_fail:
                 # Do nothing, we want to keep going
+                if failed_nodes is not None:
+                    failed_nodes.add(node)
                 return
             else:
                 if len(e.args) > 0:
@@ -505,7 +883,9 @@ class Graph:
         # Save results
         self.set_value(node, res)
 
-    def evaluate_conditional(self, conditional, continue_on_fail=False):
+    def evaluate_conditional(
+        self, conditional, continue_on_fail=False, failed_nodes=None
+    ):
         """
         Evaluate a conditional.
         """
@@ -513,21 +893,24 @@ class Graph:
         if self.has_value(conditional):
             self.get_value(conditional)
             return
+        # Check if it already failed
+        if failed_nodes is not None and conditional in failed_nodes:
+            return
+        # Only the possibility selected by the conditions is evaluated, the others are never computed
         # If not, check if one of the conditions already has a true value
-        for index, condition in enumerate(self.get_conditions(conditional)):
-            if self.has_value(condition) and self.get_value(condition):
-                break
-        else:
-            # Happens only if loop is never broken
+        index = self._get_index_of_true_condition(conditional)
+        if index is None:
             # In this case, evaluate the conditions until one is found true
             for index, condition in enumerate(self.get_conditions(conditional)):
-                self.evaluate_target(condition, continue_on_fail)
+                self.evaluate_target(condition, continue_on_fail, failed_nodes)
                 if self.has_value(condition) and self.get_value(condition):
                     break
                 elif not self.has_value(condition):
                     # Computing failed
                     if continue_on_fail:
                         # Do nothing, we want to keep going
+                        if failed_nodes is not None:
+                            failed_nodes.add(conditional)
                         return
                     else:
                         raise ValueError("Node " + condition + " could not be computed")
@@ -537,17 +920,37 @@ class Graph:
         # Actual computation happens here
         try:
             possibility = self.get_possibilities(conditional)[index]
-            self.evaluate_target(possibility, continue_on_fail)
+            self.evaluate_target(possibility, continue_on_fail, failed_nodes)
             res = self.get_value(possibility)
         except:
             if continue_on_fail:
                 # Do nothing, we want to keep going
+                if failed_nodes is not None:
+                    failed_nodes.add(conditional)
                 return
             else:
                 raise ValueError("Node " + possibility + " could not be computed")
         # Save results and release
         self.set_value(conditional, res)
 
+    def _get_index_of_true_condition(self, conditional):
+        """
+        Get the index of the first condition of a conditional that has a true value, or None if no condition is known to be true.
+        """
+        nodes = self.nodes
+        for index, condition in enumerate(self.get_conditions(conditional)):
+            # Read the attributes directly, since this runs for every conditional at every evaluation
+            attributes = nodes[condition]
+            if not attributes["has_value"]:
+                continue
+            value = attributes["value"]
+            if value is None:
+                # Raises the appropriate error
+                self.get_value(condition)
+            if value:
+                return index
+        return None
+
     def execute_to_targets(self, *targets):
         """
         Evaluate all nodes in the graph that are needed to reach the targets.
@@ -555,19 +958,157 @@ class Graph:
         for target in targets:
             self.evaluate_target(target, False)
 
+    def execute_to_targets_concurrently(
+        self, *targets, max_workers=None, executor=None
+    ):
+        """
+        Evaluate all nodes in the graph that are needed to reach the targets, calling independent recipes concurrently.
+
+        Each recipe is submitted to a pool of threads as soon as all its dependencies have values.
+        Values are read and stored only by the calling thread.
+        This pays off when recipes release the GIL, e.g., because they perform I/O or call compiled extensions.
+        Pure python recipes can run in parallel by passing a concurrent.futures.ProcessPoolExecutor, if they and their arguments can be pickled.
+        As in execute_to_targets, only the selected possibility of each conditional is evaluated.
+
+        Parameters
+        ----------
+        targets: hashables (typically strings)
+            Names of the nodes to evaluate
+        max_workers: int
+            Maximum number of threads (default: None, i.e., the default of concurrent.futures.ThreadPoolExecutor)
+        executor: concurrent.futures.Executor
+            Executor to which recipes are submitted (default: None, i.e., a new concurrent.futures.ThreadPoolExecutor with max_workers threads, shut down at the end)
+            A given executor is not shut down, so that it can be reused across calls
+            Cannot be passed together with max_workers
+        """
+        if executor is not None and max_workers is not None:
+            raise ValueError("Cannot pass both max_workers and executor")
+        plan = self._get_plan()
+        # Map from each node being evaluated to the set of its dependencies that still have no value
+        waiting = {}
+        # Map from each node being evaluated to the list of nodes waiting for it
+        dependents = {}
+        # Nodes whose dependencies all have values
+        ready = []
+
+        def wait_for(node, dependency):
+            waiting[node].add(dependency)
+            dependents.setdefault(dependency, []).append(node)
+
+        def complete(node):
+            del waiting[node]
+            for dependent in dependents.pop(node, ()):
+                missing = waiting[dependent]
+                missing.discard(node)
+                if len(missing) == 0:
+                    ready.append(dependent)
+
+        def get_next_dependency_of_conditional(conditional):
+            # Return the next node that the conditional needs, or set its value and return None if it needs nothing
+            index = self._get_index_of_true_condition(conditional)
+            if index is None:
+                for condition in self.get_conditions(conditional):
+                    if not self.has_value(condition):
+                        return condition
+                index = -1
+            possibility = self.get_possibilities(conditional)[index]
+            if not self.has_value(possibility):
+                return possibility
+            self.set_value(conditional, self.get_value(possibility))
+            return None
+
+        def require(*nodes):
+            to_visit = list(nodes)
+            while len(to_visit) > 0:
+                node = to_visit.pop()
+                if node in waiting or self.has_value(node):
+                    continue
+                waiting[node] = set()
+                if self.get_type(node) == "conditional":
+                    dependencies = (get_next_dependency_of_conditional(node),)
+                    if dependencies[0] is None:
+                        complete(node)
+                        continue
+                else:
+                    dependencies = plan.predecessors[node]
+                for dependency in dependencies:
+                    if not self.has_value(dependency):
+                        wait_for(node, dependency)
+                        to_visit.append(dependency)
+                if len(waiting[node]) == 0:
+                    ready.append(node)
+
+        if executor is None:
+            executor_context = concurrent.futures.ThreadPoolExecutor(max_workers)
+        else:
+            executor_context = contextlib.nullcontext(executor)
+        with executor_context as pool:
+            futures = {}
+            try:
+                require(*targets)
+                while len(ready) > 0 or len(futures) > 0:
+                    while len(ready) > 0:
+                        node = ready.pop()
+                        if self.get_type(node) == "conditional":
+                            dependency = get_next_dependency_of_conditional(node)
+                            if dependency is None:
+                                complete(node)
+                            else:
+                                wait_for(node, dependency)
+                                require(dependency)
+                            continue
+                        try:
+                            arguments = plan.arguments.get(node)
+                            if arguments is None:
+                                # Raises the appropriate error
+                                self.get_recipe(node)
+                            recipe, args, kwargs = arguments
+                            func = self._get_recipe_function(recipe)
+                            future = pool.submit(
+                                func,
+                                *map(self.get_value, args),
+                                **{key: self.get_value(value) for key, value in kwargs}
+                            )
+                        except Exception as e:
+                            function_compiler.annotate_exception(e, node)
+                            raise
+                        futures[future] = node
+                    if len(futures) == 0:
+                        continue
+                    done, _ = concurrent.futures.wait(
+                        futures, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        node = futures.pop(future)
+                        try:
+                            res = future.result()
+                        except Exception as e:
+                            function_compiler.annotate_exception(e, node)
+                            raise
+                        self.set_value(node, res)
+                        complete(node)
+            except:
+                # Do not start recipes whose results would be discarded
+                for future in futures:
+                    future.cancel()
+                raise
+
     def progress_towards_targets(self, *targets):
         """
         Move towards the targets by evaluating nodes, but keep going if evaluation fails.
         """
+        # Nodes that fail once would fail again, so remember them across targets
+        failed_nodes = set()
         for target in targets:
-            self.evaluate_target(target, True)
+            self.evaluate_target(target, True, failed_nodes)
 
     def execute_towards_conditions(self, *conditions):
         """
         Move towards the conditions, stop if one is found true.
         """
+        failed_nodes = set()
         for condition in conditions:
-            self.evaluate_target(condition, True)
+            self.evaluate_target(condition, True, failed_nodes)
             if self.has_value(condition) and self[condition]:
                 break
 
@@ -581,126 +1122,144 @@ class Graph:
         """
         Generic interface to find the reachability of a GenericNode.
         """
-        if self.get_type(target) == "standard":
-            return self.find_reachability_standard(target)
-        elif self.get_type(target) == "conditional":
-            return self.find_reachability_conditional(target)
-        else:
-            raise ValueError(
-                "Finding the reachability of nodes of type "
-                + self.get_type(target)
-                + " is not supported"
-            )
+        self._find_reachability(target, "target")
 
     def find_reachability_standard(self, node):
         """
         Find the reachability of a standard node.
         """
-        # Check if it already has a reachability
-        if self.has_reachability(node):
-            return
-        # Check if it already has a value
-        if self.has_value(node):
-            self.set_reachability(node, "reachable")
-            return
-        # If not, check the missing dependencies of all arguments
-        dependencies = set(self._nxdg.predecessors(node))
-        if len(dependencies) == 0:
-            # If this node does not have predecessors (and does not have a value itself), it is not reachable
-            self.set_reachability(node, "unreachable")
-            return
-        # Otherwise, dependencies must be checked
-        self.find_reachability_targets(*dependencies)
-        self.set_reachability(node, self.get_worst_reachability(*dependencies))
+        self._find_reachability(node, "standard")
 
     def find_reachability_conditional(self, conditional):
         """
         Find the reachability of a conditional.
         """
-        # Check if it already has a reachability
-        if self.has_reachability(conditional):
-            return
-        # Check if it already has a value
-        if self.has_value(conditional):
-            self.get_value(conditional)
-            self.set_reachability(conditional, "reachable")
-            return
-        # If not, evaluate the conditions until one is found true
-        for index, condition in enumerate(self.get_conditions(conditional)):
-            if self.has_value(condition) and self.get_value(condition):
-                # A condition is true
-                possibility = self.get_possibilities(conditional)[index]
-                self.find_reachability_target(possibility)
-                self.set_reachability(conditional, self.get_reachability(possibility))
-                return
-        else:
-            # Happens if loop is never broken, i.e. when no conditions are true
-            # If all conditions and possibilities are reachable -> reachable
-            # If all conditions and possibilities are unreachable -> unreachable
-            # If some conditions are reachable or uncertain but the corresponding possibilities are all unreachable -> unreachable
-            # In all other cases -> uncertain
-            self.find_reachability_targets(*self.get_conditions(conditional))
-            self.find_reachability_targets(*self.get_possibilities(conditional))
+        self._find_reachability(conditional, "conditional")
 
-            if (
-                self.get_worst_reachability(
-                    *(
-                        self.get_conditions(conditional)
-                        + self.get_possibilities(conditional)
+    def _find_reachability(self, node, kind):
+        """
+        Find the reachability of a node, treated as kind ("standard", "conditional" or "target", i.e., according to its type).
+
+        Dependencies are visited with an explicit stack rather than recursively, so that long chains do not hit the recursion limit.
+        Each node is labelled once all the dependencies it needs are, and dependencies that are not needed are never visited.
+        """
+        predecessors = self._get_plan().predecessors
+        # Each frame is (node, kind, expanded), where expanded tells if the needed dependencies have been pushed already
+        to_visit = [(node, kind, False)]
+        while len(to_visit) > 0:
+            node, kind, expanded = to_visit.pop()
+            # Check if it already has a reachability
+            if self.has_reachability(node):
+                continue
+            if kind == "target":
+                kind = self.get_type(node)
+                if kind not in ("standard", "conditional"):
+                    raise ValueError(
+                        "Finding the reachability of nodes of type "
+                        + kind
+                        + " is not supported"
                     )
-                )
-                == "reachable"
-            ):
-                # All conditions and possibilities are reachable -> reachable
-                self.set_reachability(conditional, "reachable")
-            elif (
-                self.get_best_reachability(
-                    *(
-                        self.get_conditions(conditional)
-                        + self.get_possibilities(conditional)
+            if expanded:
+                if kind == "standard":
+                    self.set_reachability(
+                        node, self.get_worst_reachability(*predecessors[node])
+                    )
+                else:
+                    self._set_reachability_conditional(node)
+                continue
+            # Check if it already has a value
+            if self.has_value(node):
+                if kind == "conditional":
+                    self.get_value(node)
+                self.set_reachability(node, "reachable")
+                continue
+            if kind == "standard":
+                # If not, check the missing dependencies of all arguments
+                dependencies = predecessors[node]
+                if len(dependencies) == 0:
+                    # If this node does not have predecessors (and does not have a value itself), it is not reachable
+                    self.set_reachability(node, "unreachable")
+                    continue
+            else:
+                # If not, check if one of the conditions is true, in which case only the corresponding possibility is needed
+                index = self._get_index_of_true_condition(node)
+                if index is not None:
+                    dependencies = [self.get_possibilities(node)[index]]
+                else:
+                    dependencies = self.get_conditions(node) + self.get_possibilities(
+                        node
                     )
+            # Otherwise, dependencies must be checked before coming back to this node
+            to_visit.append((node, kind, True))
+            for dependency in dependencies:
+                to_visit.append((dependency, "target", False))
+
+    def _set_reachability_conditional(self, conditional):
+        """
+        Set the reachability of a conditional from the reachabilities of its dependencies.
+        """
+        index = self._get_index_of_true_condition(conditional)
+        if index is not None:
+            possibility = self.get_possibilities(conditional)[index]
+            self.set_reachability(conditional, self.get_reachability(possibility))
+            return
+        # No conditions are true
+        # If all conditions and possibilities are reachable -> reachable
+        # If all conditions and possibilities are unreachable -> unreachable
+        # If some conditions are reachable or uncertain but the corresponding possibilities are all unreachable -> unreachable
+        # In all other cases -> uncertain
+        if (
+            self.get_worst_reachability(
+                *(
+                    self.get_conditions(conditional)
+                    + self.get_possibilities(conditional)
                 )
+            )
+            == "reachable"
+        ):
+            # All conditions and possibilities are reachable -> reachable
+            self.set_reachability(conditional, "reachable")
+        elif (
+            self.get_best_reachability(
+                *(
+                    self.get_conditions(conditional)
+                    + self.get_possibilities(conditional)
+                )
+            )
+            == "unreachable"
+        ):
+            # All conditions and possibilities are unreachable -> unreachable
+            self.set_reachability(conditional, "unreachable")
+        else:
+            not_unreachable_condition_possibilities = []
+            for index, condition in enumerate(self.get_conditions(conditional)):
+                if self.get_reachability(condition) != "unreachable":
+                    not_unreachable_condition_possibilities.append(
+                        self.get_possibilities(conditional)[index]
+                    )
+            if (
+                self.get_best_reachability(*not_unreachable_condition_possibilities)
                 == "unreachable"
             ):
-                # All conditions and possibilities are unreachable -> unreachable
+                # All corresponding possibilities are unreachable -> unreachable
                 self.set_reachability(conditional, "unreachable")
             else:
-                not_unreachable_condition_possibilities = []
-                for index, condition in enumerate(self.get_conditions(conditional)):
-                    if self.get_reachability(condition) != "unreachable":
-                        not_unreachable_condition_possibilities.append(
-                            self.get_possibilities(conditional)[index]
-                        )
-                if (
-                    self.get_best_reachability(*not_unreachable_condition_possibilities)
-                    == "unreachable"
-                ):
-                    # All corresponding possibilities are unreachable -> unreachable
-                    self.set_reachability(conditional, "unreachable")
-                else:
-                    self.set_reachability(conditional, "uncertain")
+                self.set_reachability(conditional, "uncertain")
 
     def get_worst_reachability(self, *nodes):
-        list_of_reachabilities = []
-        for node in nodes:
-            list_of_reachabilities.append(self.get_reachability(node))
-        if "unreachable" in list_of_reachabilities:
-            return "unreachable"
-        elif "uncertain" in list_of_reachabilities:
-            return "uncertain"
-        else:
-            return "reachable"
+        # If there are no nodes, nothing can prevent reachability
+        return min(
+            map(self.get_reachability, nodes),
+            key=reachability_ranks.__getitem__,
+            default="reachable",
+        )
 
     def get_best_reachability(self, *nodes):
-        list_of_reachabilities = []
-        for node in nodes:
-            list_of_reachabilities.append(self.get_reachability(node))
-        if "reachable" in list_of_reachabilities:
-            return "reachable"
-        elif "uncertain" in list_of_reachabilities:
-            return "uncertain"
-        else:
-            return "unreachable"
+        return max(
+            map(self.get_reachability, nodes),
+            key=reachability_ranks.__getitem__,
+            default="unreachable",
+        )
 
     def find_reachability_targets(self, *targets):
         for target in targets:
@@ -763,8 +1322,10 @@ class Graph:
         self._nxdg = res
         # Refresh alias for easy access
         self.nodes = self._nxdg.nodes
+        self._invalidate_plan()
 
     def simplify_dependency(self, node_name, dependency_name):
+        self._invalidate_plan()
         # Make everything a keyword argument. This is the fate of a simplified node
         self.get_kwargs(node_name).update(
             {argument: argument for argument in self.get_args(node_name)}
@@ -839,6 +1400,25 @@ class Graph:
             if dependency not in exclude:
                 self.simplify_dependency(node_name, dependency)
 
+    def remove_unused_nodes(self, *targets):
+        """
+        Remove all nodes that are neither targets nor ancestors of targets.
+
+        This is useful after simplifications, which leave behind the nodes whose computation was absorbed in the simplified ones.
+
+        Parameters
+        ----------
+        targets: hashables (typically strings)
+            Names of the nodes to keep together with their ancestors
+        """
+        used = set(targets)
+        for target in targets:
+            used |= self.get_all_ancestors_target(target)
+        unused = [node for node in self.nodes if node not in used]
+        if len(unused) > 0:
+            self._invalidate_plan()
+            self._nxdg.remove_nodes_from(unused)
+
     def freeze(self, *args):
         if len(args) == 0:  # Interpret as "Freeze everything"
             nodes_to_freeze = self.nodes
@@ -862,13 +1442,14 @@ class Graph:
         """
         Make dependencies (predecessors) of recipes also recipes, if they have only recipe successors
         """
+        plan = self._get_plan()
         # Work in reverse topological order, to get successors before predecessors
-        for node in reversed(self.get_topological_order()):
+        for node in reversed(plan.order):
             if self.is_recipe(node):
-                for parent in self._nxdg.predecessors(node):
+                for parent in plan.predecessors[node]:
                     if not self.is_recipe(parent):
                         all_children_are_recipes = True
-                        for child in self._nxdg.successors(parent):
+                        for child in plan.successors[parent]:
                             if not self.is_recipe(child):
                                 all_children_are_recipes = False
                                 break
@@ -880,49 +1461,207 @@ class Graph:
         Perform operations that should typically be done after the definition of a graph is completed
 
         Currently, this freezes all values, because it is assumed that values given during definition are to be frozen.
-        It also marks dependencies of recipes as recipes themselves.
-        """
-        self.make_recipe_dependencies_also_recipes()
-        self.update_topological_generation_indexes()
+        It also marks dependencies of recipes as recipes themselves, and freezes the structure of the graph in a plan for fast traversal.
+        """
+        # Structural work is only needed if the structure changed since the last finalization
+        if self._definition_dirty:
+            self._get_plan()
+            self.make_recipe_dependencies_also_recipes()
+            self.update_topological_generation_indexes()
+            self._definition_dirty = False
+        # Values may have been added in the meantime, so always freeze
         self.freeze()
 
+    def _get_plan(self):
+        """
+        Get the frozen plan of the structure, building it if needed.
+        """
+        if self._plan is None:
+            self._plan = self._build_plan()
+        return self._plan
+
+    def _build_plan(self):
+        """
+        Build a frozen plan from the current structure of the graph.
+        """
+        predecessors = {
+            node: tuple(self._nxdg.predecessors(node)) for node in self.nodes
+        }
+        successors = {node: tuple(self._nxdg.successors(node)) for node in self.nodes}
+        # Kahn's algorithm, one generation at a time, which gives both the order and the generations in one pass
+        # The order of nodes is the same as in networkx
+        in_degrees = {node: len(predecessors[node]) for node in self.nodes}
+        generation = [node for node, in_degree in in_degrees.items() if in_degree == 0]
+        generations = []
+        while len(generation) > 0:
+            generations.append(tuple(generation))
+            next_generation = []
+            for node in generation:
+                for successor in successors[node]:
+                    in_degrees[successor] -= 1
+                    if in_degrees[successor] == 0:
+                        next_generation.append(successor)
+            generation = next_generation
+        order = tuple(node for generation in generations for node in generation)
+        if len(order) < len(in_degrees):
+            raise nx.NetworkXUnfeasible("Graph contains a cycle")
+        # Collect the arguments of steps and the conditionals in a single pass over the node attributes
+        arguments = {}
+        conditionals = []
+        for node, attributes in self.nodes.items():
+            if attributes.get("recipe") is not None:
+                arguments[node] = (
+                    attributes["recipe"],
+                    tuple(attributes.get("args") or ()),
+                    tuple((attributes.get("kwargs") or {}).items()),
+                )
+            if attributes["type"] == "conditional":
+                conditionals.append(node)
+        return FrozenPlan(
+            order=order,
+            generations=tuple(generations),
+            predecessors=predecessors,
+            successors=successors,
+            arguments=arguments,
+            callers=build_callers(arguments),
+            sources=generations[0] if len(generations) > 0 else (),
+            sinks=tuple(node for node in order if len(successors[node]) == 0),
+            conditionals=tuple(conditionals),
+        )
+
+    def _remove_from_plan(self, plan, node):
+        """
+        Build the plan of the structure obtained by removing a node from the structure described by plan.
+        """
+        predecessors = dict(plan.predecessors)
+        successors = dict(plan.successors)
+        del predecessors[node]
+        del successors[node]
+        for predecessor in plan.predecessors[node]:
+            successors[predecessor] = tuple(
+                successor for successor in successors[predecessor] if successor != node
+            )
+        for successor in plan.successors[node]:
+            predecessors[successor] = tuple(
+                predecessor
+                for predecessor in predecessors[successor]
+                if predecessor != node
+            )
+        arguments = dict(plan.arguments)
+        arguments.pop(node, None)
+        callers = dict(plan.callers)
+        callers.pop(node, None)
+        # Removing a node keeps the order valid, but descendants may move to earlier generations
+        order = tuple(other for other in plan.order if other != node)
+        generation_indexes = {}
+        generations = []
+        for other in order:
+            index = 1 + max(
+                (
+                    generation_indexes[predecessor]
+                    for predecessor in predecessors[other]
+                ),
+                default=-1,
+            )
+            generation_indexes[other] = index
+            if index == len(generations):
+                generations.append([])
+            generations[index].append(other)
+        generations = tuple(tuple(generation) for generation in generations)
+        return FrozenPlan(
+            order=order,
+            generations=generations,
+            predecessors=predecessors,
+            successors=successors,
+            arguments=arguments,
+            callers=callers,
+            sources=generations[0] if len(generations) > 0 else (),
+            sinks=tuple(other for other in order if len(successors[other]) == 0),
+            conditionals=tuple(
+                conditional for conditional in plan.conditionals if conditional != node
+            ),
+        )
+
+    def _invalidate_plan(self):
+        """
+        Discard the frozen plan. To be called whenever the structure of the graph changes.
+        """
+        self._plan = None
+        self._fingerprint = None
+        self._definition_dirty = True
+        # Node attributes may have been replaced wholesale (e.g. by merge), so drop cached functions
+        self._recipe_functions = {}
+        self._ancestors = {}
+        self._ancestor_masks = {}
+        self._order_indexes = None
+
+    def _get_fingerprint(self):
+        """
+        Get a fingerprint of the structure that is invariant under isomorphism, building it if needed.
+        Graphs with different fingerprints are never equal, while graphs with the same fingerprint must be compared in full.
+        """
+        if self._fingerprint is None:
+            self._fingerprint = (
+                self._nxdg.number_of_nodes(),
+                self._nxdg.number_of_edges(),
+                tuple(
+                    sorted(
+                        (self._nxdg.in_degree(node), self._nxdg.out_degree(node))
+                        for node in self.nodes
+                    )
+                ),
+            )
+        return self._fingerprint
+
+    def _get_attribute_summary(self):
+        """
+        Get a summary of node attributes that is invariant under isomorphism.
+        It is not cached because these attributes change without structural changes.
+        """
+        return collections.Counter(
+            (
+                attributes.get("type"),
+                attributes.get("is_recipe"),
+                attributes.get("is_frozen"),
+                attributes.get("has_value"),
+            )
+            for attributes in self._nxdg.nodes.values()
+        )
+
     def get_topological_order(self):
         """
         Return list of nodes in topological order, i.e., from dependencies to targets
         """
-        return list(nx.topological_sort(self._nxdg))
+        return list(self._get_plan().order)
+
+    def get_dependencies(self, node):
+        """
+        Return list of the dependencies of a node, in the order in which they are evaluated
+        """
+        return list(self._get_plan().predecessors[node])
 
     def get_topological_generations(self):
         """
         Return list of topological generations of the graph
         """
-        return list(nx.topological_generations(self._nxdg))
+        return [list(generation) for generation in self._get_plan().generations]
 
     def update_topological_generation_indexes(self):
-        generations = self.get_topological_generations()
-        for node in self.nodes:
-            for index, generation in enumerate(generations):
-                if node in generation:
-                    self.set_topological_generation_index(node, index)
-                    break
+        for index, generation in enumerate(self._get_plan().generations):
+            for node in generation:
+                self.set_topological_generation_index(node, index)
 
     def get_all_sources(self, exclude_recipes=False):
-        sources = set()
-        for node in self.nodes:
-            if exclude_recipes and self.is_recipe(node):
-                continue
-            if self._nxdg.in_degree(node) == 0:
-                sources.add(node)
-        return sources
+        sources = self._get_plan().sources
+        if exclude_recipes:
+            return {node for node in sources if not self.is_recipe(node)}
+        return set(sources)
 
     def get_all_sinks(self, exclude_recipes=False):
-        sinks = set()
-        for node in self.nodes:
-            if exclude_recipes and self.is_recipe(node):
-                continue
-            if self._nxdg.out_degree(node) == 0:
-                sinks.add(node)
-        return sinks
+        sinks = self._get_plan().sinks
+        if exclude_recipes:
+            return {node for node in sinks if not self.is_recipe(node)}
+        return set(sinks)
 
     def convert_conditional_to_trivial_step(
         self, conditional, execute_towards_conditions=False
@@ -940,10 +1679,8 @@ class Graph:
         if execute_towards_conditions:
             self.execute_towards_all_conditions_of_conditional(conditional)
 
-        for index, condition in enumerate(self.get_conditions(conditional)):
-            if self.has_value(condition) and self.get_value(condition):
-                break
-        else:  # Happens if loop is never broken, i.e. when no conditions are true
+        index = self._get_index_of_true_condition(conditional)
+        if index is None:  # No conditions are true
             if (
                 len(self.get_conditions(conditional))
                 == len(self.get_possibilities(conditional)) - 1
@@ -959,6 +1696,7 @@ class Graph:
         # Get the correct possibility
         selected_possibility = self.get_possibilities(conditional)[index]
 
+        self._invalidate_plan()
         # Remove all previous edges (the correct one will be readded later)
         for condition in self.get_conditions(conditional):
             self._nxdg.remove_edge(condition, conditional)
@@ -979,7 +1717,7 @@ class Graph:
         self.set_is_recipe(recipe, True)
         self._nxdg.add_edge(recipe, conditional)
         # Assign value of identity function to recipe
-        self.set_value(recipe, lambda x: x)
+        self.set_value(recipe, trivial_recipe)
 
         # Add and connect the possibility
         self._nxdg.add_edge(selected_possibility, conditional)
@@ -988,11 +1726,7 @@ class Graph:
         """
         Get set of all conditional nodes in the graph.
         """
-        conditionals = set()
-        for node in self.nodes:
-            if self.get_type(node) == "conditional":
-                conditionals.add(node)
-        return conditionals
+        return set(self._get_plan().conditionals)
 
     def convert_all_conditionals_to_trivial_steps(
         self, execute_towards_conditions=False
@@ -1012,58 +1746,117 @@ class Graph:
             )
 
     def get_subgraph(self, nodes):
-        h = copy.deepcopy(self)
-        h._nxdg.remove_nodes_from([n for n in self._nxdg if n not in nodes])
-        return h
+        # Only the kept nodes are copied, rather than copying everything and removing the rest
+        return self.__class__(copy.deepcopy(self._nxdg.subgraph(nodes).copy()))
 
     def get_all_ancestors_target(self, target):
         """
         Get all the ancestors of a node.
         """
-        return nx.ancestors(self._nxdg, target)
+        # Ancestors only depend on the structure, so they are cached until it changes
+        if target not in self._ancestors:
+            if target not in self.nodes:
+                raise nx.NetworkXError(
+                    "The node " + str(target) + " is not in the digraph."
+                )
+            order = self._get_plan().order
+            mask = self._get_ancestor_mask(target)
+            ancestors = []
+            while mask:
+                lowest_bit = mask & -mask
+                ancestors.append(order[lowest_bit.bit_length() - 1])
+                mask ^= lowest_bit
+            self._ancestors[target] = frozenset(ancestors)
+        return set(self._ancestors[target])
+
+    def _get_ancestor_mask(self, target):
+        """
+        Get the ancestors of a node as an integer bitmask, where bit i stands for the i-th node in topological order.
+        Masks are built only for the node and its ancestors, and cached until the structure changes.
+        """
+        masks = self._ancestor_masks
+        if target not in masks:
+            plan = self._get_plan()
+            if self._order_indexes is None:
+                self._order_indexes = {
+                    node: index for index, node in enumerate(plan.order)
+                }
+            indexes = self._order_indexes
+            # Visit in post-order without recursion, so that long chains do not hit the recursion limit
+            to_visit = [target]
+            while len(to_visit) > 0:
+                node = to_visit[-1]
+                if node in masks:
+                    to_visit.pop()
+                    continue
+                missing = [
+                    predecessor
+                    for predecessor in plan.predecessors[node]
+                    if predecessor not in masks
+                ]
+                if len(missing) > 0:
+                    to_visit.extend(missing)
+                    continue
+                mask = 0
+                for predecessor in plan.predecessors[node]:
+                    mask |= masks[predecessor] | (1 << indexes[predecessor])
+                masks[node] = mask
+                to_visit.pop()
+        return masks[target]
 
     def get_path_to_target(self, target):
         """
         Generic interface to get the path from the last valued nodes to a target.
         """
-        if self.get_type(target) == "standard":
-            return self.get_path_to_standard(target)
-        elif self.get_type(target) == "conditional":
-            return self.get_path_to_conditional(target)
-        else:
-            raise ValueError(
-                "Getting the ancestors of nodes of type "
-                + self.get_type(target)
-                + " is not supported"
-            )
+        return self._get_path(target, "target")
 
     def get_path_to_standard(self, node):
         """
         Get the path from the last valued nodes to a standard node.
         """
-        result = set((node,))
-        if self.has_value(node):
-            return result
-        dependencies = self._nxdg.predecessors(node)
-        for dependency in dependencies:
-            result = result | self.get_path_to_target(dependency)
-        return result
+        return self._get_path(node, "standard")
 
     def get_path_to_conditional(self, conditional):
         """
         Get the path from the last valued nodes to a conditional node.
         """
-        result = set((conditional,))
-        if self.has_value(conditional):
-            return result
-        # If not, evaluate the conditions until one is found true
-        for index, condition in enumerate(self.get_conditions(conditional)):
-            if self.has_value(condition) and self.get_value(condition):
-                # A condition is true
-                possibility = self.get_possibilities(conditional)[index]
-                result = result | self.get_path_to_standard(condition)
-                result = result | self.get_path_to_standard(possibility)
-                return result
-        # If no conditions are true, we need to compute them, so all ancestors are in the path
-        result = self.get_path_to_standard(conditional)
+        return self._get_path(conditional, "conditional")
+
+    def _get_path(self, node, kind):
+        """
+        Get the path from the last valued nodes to a node, treated as kind ("standard", "conditional" or "target", i.e., according to its type).
+
+        Nodes are visited with an explicit stack and at most once per kind, so that shared dependencies are not visited again.
+        """
+        predecessors = self._get_plan().predecessors
+        result = set()
+        visited = set()
+        to_visit = [(node, kind)]
+        while len(to_visit) > 0:
+            item = to_visit.pop()
+            if item in visited:
+                continue
+            visited.add(item)
+            node, kind = item
+            if kind == "target":
+                kind = self.get_type(node)
+                if kind not in ("standard", "conditional"):
+                    raise ValueError(
+                        "Getting the ancestors of nodes of type "
+                        + kind
+                        + " is not supported"
+                    )
+            result.add(node)
+            if self.has_value(node):
+                continue
+            if kind == "conditional":
+                # Check if one of the conditions is true
+                index = self._get_index_of_true_condition(node)
+                if index is not None:
+                    to_visit.append((self.get_conditions(node)[index], "standard"))
+                    to_visit.append((self.get_possibilities(node)[index], "standard"))
+                    continue
+                # If no conditions are true, we need to compute them, so all ancestors are in the path
+            for dependency in predecessors[node]:
+                to_visit.append((dependency, "target"))
         return result
@@ -0,0 +1,239 @@
+"""
+Some tools to compile a sequence of steps into a single function.
+
+Author: Giulio Foletto <giulio.foletto@outlook.com>.
+License: See project-level license file.
+"""
+
+import functools
+import keyword
+
+
+def annotate_exception(exception, name):
+    """
+    Prefix the message of an exception with the name of the node whose evaluation raised it.
+    """
+    if len(exception.args) > 0:
+        exception.args = (
+            "While evaluating " + str(name) + ": " + str(exception.args[0]),
+        ) + exception.args[1:]
+
+
+@functools.lru_cache(maxsize=128)
+def compile_source(source):
+    """
+    Compile the source of a factory of compiled functions.
+
+    Sources only depend on the shape of the computation, because all python objects are passed to the factory.
+    Hence, graphs with the same shape share the compiled code, even if their recipes differ.
+    """
+    return compile(source, "<grapes compiled function>", "exec")
+
+
+def compile_function(steps, input_keys, targets, constants, input_as_kwargs=True):
+    """
+    Compile a sequence of steps into a single function.
+
+    Steps become straight-line code, computed in the same order as Graph.execute_to_targets.
+    Conditionals must have been decided in advance, so each one only computes the possibility that it selects.
+
+    Parameters
+    ----------
+    steps: list of tuples
+        Steps in any order. Each standard step is a tuple (name, recipe, args, kwargs), where recipe is the name of the node that holds the function, args is a tuple of node names and kwargs is a dict from keywords to node names. Each conditional step is a tuple (name, possibility) of the name of the conditional and the name of the possibility that it selects
+    input_keys: list of hashables
+        Names of the nodes whose values are the input of the compiled function
+    targets: list of hashables
+        Names of the nodes whose values are the output of the compiled function
+    constants: dict
+        Values of the nodes that are needed by the steps but are neither input nor computed by the steps
+    input_as_kwargs: bool
+        Whether the compiled function takes the input as kwargs (default: True) or as positional args
+
+    Returns
+    -------
+    callable
+        Function that computes the targets from the input. It returns a single value if there is only one target, otherwise a list.
+    """
+    # Every node is handled as a local variable of the compiled function
+    # Every python object that must be accessed by the compiled function is bound as a free variable
+    variables = {}
+    bound_names = []
+    bound_objects = []
+
+    def bind(obj):
+        bound_name = "c" + str(len(bound_objects))
+        bound_names.append(bound_name)
+        bound_objects.append(obj)
+        return bound_name
+
+    def variable(node):
+        if node not in variables:
+            variables[node] = "v" + str(len(variables))
+        return variables[node]
+
+    body = []
+    for index, key in enumerate(input_keys):
+        if input_as_kwargs:
+            body.append(variable(key) + " = kwargs[" + bind(key) + "]")
+        else:
+            body.append(variable(key) + " = args[" + str(index) + "]")
+    for key, value in constants.items():
+        body.append(variable(key) + " = " + bind(value))
+
+    definitions = {step[0]: step for step in steps}
+    step_names = []
+    step_names_name = bind(step_names)
+    annotate_name = bind(annotate_exception)
+
+    def get_dependencies(node):
+        # Dependencies in the order in which Graph.evaluate_target visits them
+        step = definitions[node]
+        if len(step) == 4:
+            return (step[1],) + tuple(step[2]) + tuple(step[3].values())
+        return (step[1],)
+
+    def emit_standard(step):
+        name, recipe, args, kwargs = step
+        arguments = [variable(arg) for arg in args]
+        irregular_kwargs = []
+        for keyword_name, value in kwargs.items():
+            if keyword_name.isidentifier() and not keyword.iskeyword(keyword_name):
+                arguments.append(keyword_name + "=" + variable(value))
+            else:
+                irregular_kwargs.append(bind(keyword_name) + ": " + variable(value))
+        if len(irregular_kwargs) > 0:
+            arguments.append("**{" + ", ".join(irregular_kwargs) + "}")
+        lines = ["step = " + str(len(step_names))]
+        step_names.append(name)
+        lines.append(
+            variable(name) + " = " + variable(recipe) + "(" + ", ".join(arguments) + ")"
+        )
+        return lines
+
+    def emit_conditional(step, lines):
+        # Wrap the lines that compute the possibility, reporting their failures as in Graph.evaluate_conditional
+        name, possibility = step
+        assignment = variable(name) + " = " + variable(possibility)
+        if len(lines) == 0:
+            return [assignment]
+        message = bind("Node " + str(possibility) + " could not be computed")
+        return (
+            ["try:"]
+            + ["    " + line for line in lines]
+            + [
+                "except Exception as e:",
+                "    if step is not None:",
+                "        " + annotate_name + "(e, " + step_names_name + "[step])",
+                "        step = None",
+                "    raise ValueError(" + message + ")",
+                assignment,
+            ]
+        )
+
+    def emit_block(roots, available):
+        # Emit the lines that compute roots, visiting nodes depth-first in the same order as Graph.evaluate_target
+        # An explicit stack is used, so that long chains of steps do not hit the recursion limit
+        lines = []
+        for root in roots:
+            # Each frame holds a node, the index of its next dependency to visit and the first line emitted for it
+            stack = [[root, 0, len(lines)]]
+            while len(stack) > 0:
+                frame = stack[-1]
+                node, index, start = frame
+                if index == 0 and node in available:
+                    stack.pop()
+                    continue
+                dependencies = get_dependencies(node)
+                while index < len(dependencies) and dependencies[index] in available:
+                    index += 1
+                if index < len(dependencies):
+                    frame[1] = index + 1
+                    stack.append([dependencies[index], 0, len(lines)])
+                    continue
+                stack.pop()
+                step = definitions[node]
+                if len(step) == 4:
+                    lines += emit_standard(step)
+                else:
+                    lines[start:] = emit_conditional(step, lines[start:])
+                available.add(node)
+        return lines
+
+    computation = emit_block(targets, set(input_keys) | set(constants))
+
+    if len(targets) == 1:
+        result = variable(targets[0])
+    else:
+        result = "[" + ", ".join(variable(target) for target in targets) + "]"
+
+    lines = [
+        "def compiled_function(" + ("**kwargs" if input_as_kwargs else "*args") + "):"
+    ]
+    lines += ["    " + line for line in body]
+    if len(computation) > 0:
+        lines.append("    step = None")
+        lines.append("    try:")
+        lines += ["        " + line for line in computation]
+        lines.append("    except Exception as e:")
+        lines.append("        if step is not None:")
+        lines.append(
+            "            " + annotate_name + "(e, " + step_names_name + "[step])"
+        )
+        lines.append("        raise")
+    lines.append("    return " + result)
+
+    # Wrap in a factory, so that bound objects are free variables rather than globals
+    source = (
+        "def factory("
+        + ", ".join(bound_names)
+        + "):\n"
+        + "\n".join("    " + line for line in lines)
+        + "\n    return compiled_function\n"
+    )
+    namespace = {}
+    exec(compile_source(source), namespace)
+    return namespace["factory"](*bound_objects)
+
+
+@functools.lru_cache(maxsize=1024)
+def get_caller(number_of_args, keywords):
+    """
+    Get a function that calls a recipe with the values of some nodes.
+
+    The returned function has signature caller(func, get, *names), where get maps node names to values and names are
+    first the names of the positional arguments and then the names of the keyword arguments.
+    The call is spelled out in straight-line code, so that no list or dict is built to gather the arguments.
+
+    Parameters
+    ----------
+    number_of_args: int
+        Number of positional arguments of the recipe
+    keywords: tuple of strings
+        Keywords of the keyword arguments of the recipe
+
+    Returns
+    -------
+    callable or None
+        The caller, or None if some keywords are not valid identifiers
+    """
+    for keyword_name in keywords:
+        if not keyword_name.isidentifier() or keyword.iskeyword(keyword_name):
+            return None
+    names = ["a" + str(index) for index in range(number_of_args)]
+    names += ["k" + str(index) for index in range(len(keywords))]
+    arguments = ["get(a" + str(index) + ")" for index in range(number_of_args)]
+    arguments += [
+        keyword_name + "=get(k" + str(index) + ")"
+        for index, keyword_name in enumerate(keywords)
+    ]
+    source = (
+        "def caller("
+        + ", ".join(["func", "get"] + names)
+        + "):\n    return func("
+        + ", ".join(arguments)
+        + ")\n"
+    )
+    namespace = {}
+    exec(compile(source, "<grapes caller>", "exec"), namespace)
+    return namespace["caller"]
@@ -6,6 +6,49 @@ License: See project-level license file.
 """
 
 import inspect
+import keyword
+import weakref
+
+from . import function_compiler
+
+# Caches of inspection results, which hold weak references so that they do not keep functions alive
+_argspecs = weakref.WeakKeyDictionary()
+_parameter_names = weakref.WeakKeyDictionary()
+
+
+def _get_cached(cache, func, compute):
+    """
+    Get compute(func) from cache, computing and storing it if needed.
+
+    Callables that cannot be hashed or weakly referenced (e.g., some builtins) are not cached.
+    """
+    try:
+        return cache[func]
+    except KeyError:
+        pass
+    except TypeError:
+        return compute(func)
+    result = compute(func)
+    cache[func] = result
+    return result
+
+
+def get_argspec(func):
+    """
+    Get the full argspec of a function, caching it because the same recipes are typically inspected many times.
+    """
+    return _get_cached(_argspecs, func, inspect.getfullargspec)
+
+
+def get_parameter_names(func):
+    """
+    Get the names of the parameters in the signature of a function, caching them as in get_argspec.
+    """
+    return _get_cached(
+        _parameter_names,
+        func,
+        lambda func: tuple(inspect.signature(func).parameters.keys()),
+    )
 
 
 def identity_token():
@@ -41,23 +84,64 @@ def function_compose(
     subfuncs_dependencies: list of lists of hashables
         Names of the arguments of the old subfuncs
     """
-    return lambda **kwargs: func(
-        **{
-            func_signature[i]: (
-                subfuncs[i](
-                    **{
-                        signature_name: kwargs[dependency_name]
-                        for signature_name, dependency_name in zip(
-                            subfuncs_signatures[i], subfuncs_dependencies[i]
-                        )
-                    }
-                )
-                if subfuncs[i] is not identity_token
-                else kwargs[func_dependencies[i]]
+    # The composition is spelled out as straight-line code, so that calling it does not loop over the subfuncs
+    # Every python object is bound as a free variable, so that the source only depends on the shape of the composition
+    bound_names = []
+    bound_objects = []
+
+    def bind(obj):
+        bound_name = "c" + str(len(bound_objects))
+        bound_names.append(bound_name)
+        bound_objects.append(obj)
+        return bound_name
+
+    def call(function_name, keywords):
+        # Keywords that are not valid identifiers are passed by unpacking a dict
+        arguments = []
+        irregular_arguments = []
+        for keyword_name, value in keywords.items():
+            if (
+                isinstance(keyword_name, str)
+                and keyword_name.isidentifier()
+                and not keyword.iskeyword(keyword_name)
+            ):
+                arguments.append(keyword_name + "=" + value)
+            else:
+                irregular_arguments.append(bind(keyword_name) + ": " + value)
+        if len(irregular_arguments) > 0:
+            arguments.append("**{" + ", ".join(irregular_arguments) + "}")
+        return function_name + "(" + ", ".join(arguments) + ")"
+
+    lines = []
+    func_keywords = {}
+    for i in range(len(subfuncs)):
+        if subfuncs[i] is identity_token:
+            value = "kwargs[" + bind(func_dependencies[i]) + "]"
+        else:
+            value = call(
+                bind(subfuncs[i]),
+                {
+                    signature_name: "kwargs[" + bind(dependency_name) + "]"
+                    for signature_name, dependency_name in zip(
+                        subfuncs_signatures[i], subfuncs_dependencies[i]
+                    )
+                },
             )
-            for i in range(len(subfuncs))
-        }
+        # Subfuncs are all evaluated in order, even if a later one overrides the same keyword of func
+        lines.append("r" + str(i) + " = " + value)
+        func_keywords[func_signature[i]] = "r" + str(i)
+    lines.append("return " + call(bind(func), func_keywords))
+
+    source = (
+        "def factory("
+        + ", ".join(bound_names)
+        + "):\n    def composed_function(**kwargs):\n"
+        + "\n".join("        " + line for line in lines)
+        + "\n    return composed_function\n"
     )
+    namespace = {}
+    exec(function_compiler.compile_source(source), namespace)
+    return namespace["factory"](*bound_objects)
 
 
 def function_compose_simple(
@@ -86,30 +170,32 @@ def function_compose_simple(
     subfuncs_dependencies: list of lists of hashables
         Names of the arguments of the old subfuncs
     """
+    # Inspect each function at most once, as inspection is relatively expensive
+    func_argspec = None
     if func_signature is None:
-        if inspect.getfullargspec(func).varargs is not None:
+        func_argspec = get_argspec(func)
+        if func_argspec.varargs is not None:
             raise ValueError(
                 "Functions with varargs are not supported by Function Composer"
             )
-        elif (
-            inspect.getfullargspec(func).varargs is None
-            and inspect.getfullargspec(func).varkw is None
-        ):  # Well defined spec
-            func_signature = list(inspect.signature(func).parameters.keys())
+        elif func_argspec.varkw is None:  # Well defined spec
+            func_signature = list(get_parameter_names(func))
         else:
             func_signature = func_dependencies
     if subfuncs_signatures is None:
         subfuncs_signatures = []
         for index, subfunc in enumerate(subfuncs):
-            if inspect.getfullargspec(func).varargs is not None:
+            if func_argspec is None:
+                func_argspec = get_argspec(func)
+            if func_argspec.varargs is not None:
                 raise ValueError(
                     "Functions with varargs are not supported by Function Composer"
                 )
-            elif (
-                inspect.getfullargspec(subfunc).varargs is None
-                and inspect.getfullargspec(subfunc).varkw is None
+            subfunc_argspec = get_argspec(subfunc)
+            if (
+                subfunc_argspec.varargs is None and subfunc_argspec.varkw is None
             ):  # Well defined spec
-                this_signature = list(inspect.signature(subfunc).parameters.keys())
+                this_signature = list(get_parameter_names(subfunc))
             else:
                 this_signature = subfuncs_dependencies[index]
             subfuncs_signatures.append(this_signature)
@@ -10,6 +10,8 @@ import json
 import sys
 import warnings
 
+from . import function_compiler
+
 # Since tomllib is only standard in 3.11, we import tomli in prior versions
 if sys.version_info.major >= 3 and sys.version_info.minor >= 11:
     import tomllib
@@ -44,9 +46,16 @@ def execute_graph_from_context(
     if len(targets) == 0:
         targets = graph.get_all_sinks(exclude_recipes=True)
 
+    # Deep-copy once, for the execution
+    if not inplace:
+        graph = copy.deepcopy(graph)
+        context = copy.deepcopy(context)
+
     if check_feasibility:
+        # Unless inplace, the check works on a shallow copy, which is enough because it only reads values,
+        # so that the result does not keep the reachabilities found by the check
         feasibility, missing_dependencies = check_feasibility_of_execution(
-            graph, context, *targets, inplace=inplace
+            graph if inplace else graph.copy(), context, *targets, inplace=True
         )
         if feasibility == "unreachable":
             raise ValueError(
@@ -59,11 +68,9 @@ def execute_graph_from_context(
                 + ", ".join(missing_dependencies)
             )
 
-    if not inplace:
-        graph = copy.deepcopy(graph)
-        context = copy.deepcopy(context)
-
-    graph.set_internal_context(context)
+    # If the check ran inplace, it has already set the context
+    if not (check_feasibility and inplace):
+        graph.set_internal_context(context)
     graph.execute_to_targets(*targets)
 
     return graph
@@ -170,6 +177,29 @@ def context_from_file(file_name):
 def wrap_graph_with_function(
     graph, input_keys, *targets, constants={}, input_as_kwargs=True
 ):
+    """Wrap a graph with a function that computes targets from some input.
+
+    Parameters
+    ----------
+    graph : grapes Graph
+        Graph of the computation.
+    input_keys : list of strings (or keys in the graph)
+        Nodes whose values are passed as input to the function.
+    targets : strings (or keys in the graph)
+        Indicator of what to compute (desired output).
+    constants : dict
+        Dictionary of values that are fixed for all calls of the function (default: {}).
+    input_as_kwargs : bool
+        Whether the function takes the input as kwargs (default: True) or as positional args.
+
+    Returns
+    -------
+    callable
+        Function that returns the values of the targets (a single value if there is only one target, otherwise a list).
+        When possible, it is compiled to code that does not touch the graph at call time.
+        The function only passes values from one recipe to the next, so, if the recipes support it, a single call can process
+        a whole batch of input, e.g., numpy arrays. Conditions must still evaluate to a single truth value.
+    """
     # Copy graph so as not to pollute the original
     operational_graph = copy.deepcopy(graph)
     # Pass all constants to the graph
@@ -186,6 +216,9 @@ def wrap_graph_with_function(
         targets = operational_graph.get_all_sinks(exclude_recipes=True)
     # Move as much as possible towards targets
     operational_graph.progress_towards_targets(*targets)
+    # Conditionals that depend on the input may have been computed from conditions that do not,
+    # but every call computes them again, so their values cannot be treated as constants
+    operational_graph.clear_values(*input_keys, include_descendants=True)
     # Check feasibility
     placeholder_value = 0
     context = {key: placeholder_value for key in input_keys}
@@ -203,32 +236,43 @@ def wrap_graph_with_function(
             + ", ".join(missing_dependencies)
         )
 
+    # Try to compile the computation
+    input_keys = list(input_keys)
+    targets = list(targets)
+    steps_to_compile = get_steps_to_compile(operational_graph, input_keys, *targets)
+    if steps_to_compile is not None:
+        steps, needed_constants = steps_to_compile
+        return function_compiler.compile_function(
+            steps, input_keys, targets, needed_constants, input_as_kwargs
+        )
+
     if input_as_kwargs:
 
         def specific_function(**kwargs):
+            # Only the input and the nodes that depend on it must be recomputed, the rest is kept from previous calls
+            # Clear before rather than after the computation, so that a failed call does not leave stale values
+            operational_graph.clear_values(*input_keys, include_descendants=True)
             # Use for loop rather than dict comprehension because it is a more basic operation
             for key in input_keys:
                 operational_graph[key] = kwargs[key]
             operational_graph.execute_to_targets(*targets)
             list_of_values = operational_graph.get_list_of_values(targets)
-            # Clear values so that the function can be called again
-            operational_graph.clear_values()
             if len(list_of_values) == 1:
                 return list_of_values[0]
             else:
                 return list_of_values
 
     else:
-        input_keys = list(input_keys)
 
         def specific_function(*args):
+            # Only the input and the nodes that depend on it must be recomputed, the rest is kept from previous calls
+            # Clear before rather than after the computation, so that a failed call does not leave stale values
+            operational_graph.clear_values(*input_keys, include_descendants=True)
             # Use for loop rather than dict comprehension because it is a more basic operation
             for i in range(len(input_keys)):
                 operational_graph[input_keys[i]] = args[i]
             operational_graph.execute_to_targets(*targets)
             list_of_values = operational_graph.get_list_of_values(targets)
-            # Clear values so that the function can be called again
-            operational_graph.clear_values()
             if len(list_of_values) == 1:
                 return list_of_values[0]
             else:
@@ -237,6 +281,109 @@ def wrap_graph_with_function(
     return specific_function
 
 
+def fold_conditional(graph, conditional, input_keys=()):
+    """Fold the conditions of a conditional whose values are already known.
+
+    Conditions that are known to be false are dropped, since they can never select their possibility.
+    The first condition that is known to be true makes its possibility the last one, since no later condition can be checked.
+    The result depends on the order of the conditions, so it decides the conditional as Graph.evaluate_conditional does
+    only if no condition is left, i.e., if the selected possibility does not depend on values that are computed at run time.
+
+    Parameters
+    ----------
+    graph : grapes Graph
+        Graph that contains the conditional.
+    conditional : string (or key in the graph)
+        Name of the conditional.
+    input_keys : iterable of strings (or keys in the graph)
+        Nodes whose values are considered as input, hence unknown (default: ()).
+
+    Returns
+    -------
+    tuple
+        Tuple (conditions, possibilities) of lists of node names, where the last possibility is selected if no condition is true.
+    """
+    folded_conditions = []
+    folded_possibilities = []
+    for condition, possibility in zip(
+        graph.get_conditions(conditional), graph.get_possibilities(conditional)
+    ):
+        if condition in input_keys or not graph.has_value(condition):
+            folded_conditions.append(condition)
+            folded_possibilities.append(possibility)
+        elif graph.get_value(condition):
+            folded_possibilities.append(possibility)
+            return folded_conditions, folded_possibilities
+    folded_possibilities.append(graph.get_possibilities(conditional)[-1])
+    return folded_conditions, folded_possibilities
+
+
+def get_steps_to_compile(graph, input_keys, *targets):
+    """Get the steps that compute targets from input, in a form that can be compiled.
+
+    Parameters
+    ----------
+    graph : grapes Graph
+        Graph of the computation.
+    input_keys : list of strings (or keys in the graph)
+        Nodes whose values are considered as input.
+    targets : strings (or keys in the graph)
+        Indicator of what to compute (desired output).
+
+    Returns
+    -------
+    tuple or None
+        Tuple (steps, constants), where steps is a list of steps in topological order, as accepted by function_compiler.compile_function,
+        and constants is a dictionary of the values that are needed by the steps but are not input.
+        None if the computation requires nodes that have neither value nor recipe, or conditionals that are not decided by the known values.
+    """
+    input_keys = set(input_keys)
+    needed = set()
+    constants = {}
+    selected_possibilities = {}
+    to_visit = list(targets)
+    while len(to_visit) > 0:
+        node = to_visit.pop()
+        if node in needed:
+            continue
+        needed.add(node)
+        if node in input_keys:
+            continue
+        if graph.has_value(node):
+            constants[node] = graph.get_value(node)
+            continue
+        if graph.get_type(node) == "conditional":
+            # Which conditions have values at run time depends on what was computed before, so only decided conditionals are compiled
+            conditions, possibilities = fold_conditional(graph, node, input_keys)
+            if len(conditions) > 0:
+                return None
+            selected_possibilities[node] = possibilities[0]
+            to_visit.append(possibilities[0])
+            continue
+        if graph.get_type(node) != "standard" or "recipe" not in graph.nodes[node]:
+            return None
+        to_visit.extend(graph.get_node_attribute(node, "args"))
+        to_visit.extend(graph.get_kwargs(node).values())
+        to_visit.append(graph.get_recipe(node))
+    steps = []
+    for node in graph.get_topological_order():
+        if node in needed and node not in input_keys and node not in constants:
+            if graph.get_type(node) == "conditional":
+                steps.append((node, selected_possibilities[node]))
+                continue
+            recipe = graph.get_recipe(node)
+            args = graph.get_args(node)
+            kwargs = graph.get_kwargs(node)
+            # Failures of possibilities are reported depending on the order of evaluation,
+            # which the compiled function can only follow if the dependencies are in the order of the definition (e.g., not after simplifications)
+            if len(selected_possibilities) > 0 and graph.get_dependencies(node) != list(
+                dict.fromkeys((recipe,) + tuple(args) + tuple(kwargs.values()))
+            ):
+                return None
+            steps.append((node, recipe, args, kwargs))
+    return steps, constants
+
+
 def lambdify_graph(graph, input_keys, target, constants={}):
     # Copy graph so as not to pollute the original
     operational_graph = copy.deepcopy(graph)
@@ -255,6 +402,14 @@ def lambdify_graph(graph, input_keys, target, constants={}):
     )
     # Progress as much as possible
     operational_graph.progress_towards_targets(target)
+    # With conditionals converted, the computation can usually be compiled to straight-line code
+    steps_to_compile = get_steps_to_compile(operational_graph, input_keys, target)
+    if steps_to_compile is not None:
+        steps, needed_constants = steps_to_compile
+        return function_compiler.compile_function(
+            steps, list(input_keys), [target], needed_constants
+        )
+    # Otherwise, fall back to composing the recipes
     # The starting point of the computation will include the constants
     initial_keys = set(input_keys) | set(constants.keys())
     # Simplify until the graph is a single function
@@ -292,10 +447,10 @@ def check_feasibility_of_execution(graph, context, *targets, inplace=False):
     feasibility = graph.get_worst_reachability(*targets)
     missing_dependencies = set()
     if feasibility in {"unreachable", "uncertain"}:
-        for node in graph.nodes:
+        # Missing dependencies are sources, i.e., the first topological generation, so there is no need to scan all nodes
+        for node in graph.get_all_sources():
             if (
-                graph.get_topological_generation_index(node) == 0
-                and graph.has_reachability(node)
+                graph.has_reachability(node)
                 and graph.get_reachability(node) != "reachable"
             ):
                 missing_dependencies.add(node)
@@ -303,10 +458,10 @@ def check_feasibility_of_execution(graph, context, *targets, inplace=False):
 
 
 def get_execution_subgraph(graph, context, *targets):
-    graph = copy.deepcopy(graph)
-    context = copy.deepcopy(context)
+    # A shallow copy is enough to find the path, since only the nodes in the path are deep-copied into the subgraph
+    graph = graph.copy()
     graph.update_internal_context(context)
     path = set()
     for target in targets:
-        path = path | graph.get_path_to_target(target)
+        path |= graph.get_path_to_target(target)
     return graph.get_subgraph(path)
@@ -29,6 +29,9 @@ def get_graphviz_digraph(
     sources = graph.get_all_sources()
     sinks = graph.get_all_sinks()
     cmap = matplotlib.colormaps[colormap]
+    color_mode = color_mode.lower()
+    # AGraph.nodes() builds a new list at every call, so membership is checked against a set kept in sync
+    remaining_nodes = set(g.nodes())
 
     for node_name in g.nodes():
         new_attrs = {}
@@ -37,6 +40,7 @@ def get_graphviz_digraph(
         # Remove recipes if needed, or eliminate attribute of function
         if node["is_recipe"] and hide_recipes:
             g.remove_node(node_name)
+            remaining_nodes.discard(node_name)
             continue
         elif node["is_recipe"] and node["has_value"]:
             new_attrs.update(value="function")
@@ -66,7 +70,7 @@ def get_graphviz_digraph(
 
         # Manipulate colors
         must_be_colored = False
-        if color_mode.lower() == "by_generation":
+        if color_mode == "by_generation":
             topological_generation_index = graph.get_node_attribute(
                 node_name, "topological_generation_index"
             )
@@ -76,7 +80,7 @@ def get_graphviz_digraph(
                 topological_generation_index / max_topological_generation_index
             )
             must_be_colored = True
-        elif color_mode.lower() == "sources_and_sinks":
+        elif color_mode == "sources_and_sinks":
             if node_name in sources:
                 color_rgba = cmap(0.0)
                 must_be_colored = True
@@ -98,11 +102,11 @@ def get_graphviz_digraph(
         # Handle edge shapes
         if node["type"] == "standard" and "recipe" in node:
             # This condition might be false for example because of hide_recipes
-            if node["recipe"] in g.nodes():
+            if node["recipe"] in remaining_nodes:
                 g.get_edge(node["recipe"], node_name).attr.update(arrowhead="dot")
         elif node["type"] == "conditional":
             for condition in node["conditions"]:
-                if condition in g.nodes():
+                if condition in remaining_nodes:
                     g.get_edge(condition, node_name).attr.update(arrowhead="diamond")
 
     # Return the AGraph (no layout is computed yet)
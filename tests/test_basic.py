@@ -5,11 +5,71 @@ Author: Giulio Foletto <giulio.foletto@outlook.com>.
 License: See project-level license file.
 """
 
+import concurrent.futures
+import copy
+import gc
+import operator
+import pickle
+import sys
+import threading
+import weakref
+
+import networkx as nx
 import pytest
 
 import grapes as gr
 
 
+# Module-level recipes, unlike lambdas, can be pickled
+def add(x, y):
+    return x + y
+
+
+def multiply(x, y):
+    return x * y
+
+
+def subtract(x, y):
+    return x - y
+
+
+def double(x):
+    return 2 * x
+
+
+def triple(x):
+    return 3 * x
+
+
+def identity(x):
+    return x
+
+
+# Recipes of the graph with e = op_e(a, b), f = op_f(c, d) and g = op_g(e, f), which many tests use
+efg_operations = {"op_e": add, "op_f": multiply, "op_g": subtract}
+
+
+@pytest.fixture(scope="module")
+def chain_graph_template():
+    """
+    Finalized graph with b = op_b(a) and c = op_c(b), built once per module. Tests must not modify it.
+    """
+    g = gr.Graph()
+    g.add_step("b", "op_b", "a")
+    g.add_step("c", "op_c", "b")
+    g.set_internal_context({"a": 1, "op_b": double, "op_c": triple})
+    g.finalize_definition()
+    return g
+
+
+@pytest.fixture
+def chain_graph(chain_graph_template):
+    """
+    Copy of the chain graph template, which tests can modify.
+    """
+    return chain_graph_template.copy()
+
+
 def test_simple():
     g = gr.Graph()
     g.add_step("a")
@@ -29,9 +89,9 @@ def test_simple():
             "a": 1,
             "b": 2,
             "f": 12,
-            "op_e": lambda x, y: x + y,
-            "op_f": lambda x, y: x * y,
-            "op_g": lambda x, y: x - y,
+            "op_e": add,
+            "op_f": multiply,
+            "op_g": subtract,
         }
     )
     g.execute_to_targets("g")
@@ -41,9 +101,13 @@ def test_simple():
 
 def test_simplified_input():
     g = gr.Graph()
-    g.add_step("e", "op_e", "a", "b")
-    g.add_step("f", "op_f", "c", "d")
-    g.add_step("g", "op_g", "e", "f")
+    g.add_steps(
+        [
+            ("e", "op_e", "a", "b"),
+            ("f", "op_f", "c", "d"),
+            ("g", "op_g", "e", "f"),
+        ]
+    )
     g.finalize_definition()
 
     g.update_internal_context(
@@ -51,9 +115,9 @@ def test_simplified_input():
             "a": 1,
             "b": 2,
             "f": 12,
-            "op_e": lambda x, y: x + y,
-            "op_f": lambda x, y: x * y,
-            "op_g": lambda x, y: x - y,
+            "op_e": add,
+            "op_f": multiply,
+            "op_g": subtract,
         }
     )
     g.execute_to_targets("g")
@@ -64,19 +128,23 @@ def test_simplified_input():
 def test_diamond():
     g = gr.Graph()
     g.add_step("a")
-    g.add_step("b", "op_b", "a")
-    g.add_step("c", "op_c", "b")
-    g.add_step("d", "op_d", "b")
-    g.add_step("e", "op_e", "c", "d")
+    g.add_steps(
+        [
+            ("b", "op_b", "a"),
+            ("c", "op_c", "b"),
+            ("d", "op_d", "b"),
+            ("e", "op_e", "c", "d"),
+        ]
+    )
     g.finalize_definition()
 
     g.update_internal_context(
         {
             "a": 1,
-            "op_b": lambda x: 2 * x,
-            "op_c": lambda x: 2 * x,
-            "op_d": lambda x: 2 * x,
-            "op_e": lambda x, y: x - y,
+            "op_b": double,
+            "op_c": double,
+            "op_d": double,
+            "op_e": subtract,
         }
     )
     g.execute_to_targets("e")
@@ -84,6 +152,33 @@ def test_diamond():
     assert g["e"] == 0
 
 
+def test_shared_dependency_is_computed_once():
+    calls = []
+
+    def op_b(x):
+        calls.append("b")
+        return 2 * x
+
+    g = gr.Graph()
+    g.add_steps(
+        [
+            ("b", "op_b", "a"),
+            ("c", "op_c", "b"),
+            ("d", "op_d", "b"),
+            ("e", "op_e", "c", "d"),
+            ("f", "op_f", "b", "e"),
+        ]
+    )
+    g.update_internal_context(
+        {"a": 1, "op_b": op_b, "op_c": double, "op_d": triple, "op_e": add, "op_f": add}
+    )
+    g.finalize_definition()
+
+    g.execute_to_targets("e", "f")
+    assert g["f"] == 12
+    assert calls == ["b"]
+
+
 def test_inverted_input():
     # Typically, we proceed from bottom to top
     # Here we test the opposite
@@ -92,9 +187,7 @@ def test_inverted_input():
     g.add_step("b", "op_b", "a")
     g.finalize_definition()
 
-    g.update_internal_context(
-        {"a": 1, "op_b": lambda x: 2 * x, "op_c": lambda x: 3 * x}
-    )
+    g.update_internal_context({"a": 1, "op_b": double, "op_c": triple})
     g.execute_to_targets("c")
 
     assert g["c"] == 6
@@ -153,9 +246,7 @@ def test_merge_and_execute():
     g.merge(h)
     g.finalize_definition()
 
-    g.update_internal_context(
-        {"a": 1, "b": 2, "d": 4, "op_c": lambda x, y: x + y, "op_e": lambda x, y: x * y}
-    )
+    g.update_internal_context({"a": 1, "b": 2, "d": 4, "op_c": add, "op_e": multiply})
     g.execute_to_targets("e")
 
     assert g["e"] == 12
@@ -175,18 +266,31 @@ def test_kwargs():
     assert g["c"] == 25
 
 
+def test_kwargs_with_non_identifier_keywords():
+    g = gr.Graph()
+    g.add_step("c", "op_c", "a", **{"exponent": "b", "not an identifier": "d"})
+    g.finalize_definition()
+
+    def example_func(base, **kwargs):
+        return base ** kwargs["exponent"] + kwargs["not an identifier"]
+
+    g.update_internal_context({"a": 5, "b": 2, "d": 1, "op_c": example_func})
+    g.execute_to_targets("c")
+
+    assert g["c"] == 26
+
+
 def test_simplify_dependency():
     g = gr.Graph()
-    g.add_step("e", "op_e", "a", "b")
-    g.add_step("f", "op_f", "c", "d")
-    g.add_step("g", "op_g", "e", "f")
+    g.add_steps(
+        [
+            ("e", "op_e", "a", "b"),
+            ("f", "op_f", "c", "d"),
+            ("g", "op_g", "e", "f"),
+        ]
+    )
 
-    operations = {
-        "op_e": lambda x, y: x + y,
-        "op_f": lambda x, y: x * y,
-        "op_g": lambda x, y: x - y,
-    }
-    g.set_internal_context(operations)
+    g.set_internal_context(efg_operations)
 
     g.simplify_dependency("g", "f")
     g.finalize_definition()
@@ -199,16 +303,15 @@ def test_simplify_dependency():
 
 def test_simplify_all_dependencies():
     g = gr.Graph()
-    g.add_step("e", "op_e", "a", "b")
-    g.add_step("f", "op_f", "c", "d")
-    g.add_step("g", "op_g", "e", "f")
+    g.add_steps(
+        [
+            ("e", "op_e", "a", "b"),
+            ("f", "op_f", "c", "d"),
+            ("g", "op_g", "e", "f"),
+        ]
+    )
 
-    operations = {
-        "op_e": lambda x, y: x + y,
-        "op_f": lambda x, y: x * y,
-        "op_g": lambda x, y: x - y,
-    }
-    g.set_internal_context(operations)
+    g.set_internal_context(efg_operations)
 
     g.simplify_all_dependencies("g")
     g.finalize_definition()
@@ -219,15 +322,60 @@ def test_simplify_all_dependencies():
     assert g["g"] == -9
 
 
+def test_remove_unused_nodes():
+    g = gr.Graph()
+    g.add_steps(
+        [
+            ("e", "op_e", "a", "b"),
+            ("f", "op_f", "c", "d"),
+            ("g", "op_g", "e", "f"),
+        ]
+    )
+    g.set_internal_context(efg_operations)
+
+    g.simplify_all_dependencies("g")
+    g.remove_unused_nodes("g")
+    assert set(g.nodes) == {"a", "b", "c", "d", "op_g", "g"}
+
+    g.finalize_definition()
+    g.update_internal_context({"a": 1, "b": 2, "c": 3, "d": 4})
+    g.execute_to_targets("g")
+    assert g["g"] == -9
+
+
+def test_simplify_dependency_with_irregular_keywords():
+    g = gr.Graph()
+    g.add_step("first term", "op_e", "a", "b")
+    g.add_step("g", "op_g", **{"first term": "first term", "c": "c"})
+
+    operations = {
+        "op_e": add,
+        "op_g": lambda **kwargs: kwargs["first term"] - kwargs["c"],
+    }
+    g.set_internal_context(operations)
+
+    g.simplify_dependency("g", "first term")
+    g.finalize_definition()
+
+    g.update_internal_context({"a": 1, "b": 2, "c": 3})
+    g.execute_to_targets("g")
+
+    assert g["g"] == 0
+
+
 def test_progress_towards_targets():
     g = gr.Graph()
-    g.add_step("b", "op_b", "a")
-    g.add_step("f", "op_f", "b", "c", "e")
-    g.add_step("e", "op_e", "d")
+    g.add_steps(
+        [
+            ("b", "op_b", "a"),
+            ("f", "op_f", "b", "c", "e"),
+            ("e", "op_e", "d"),
+        ]
+    )
 
     context = {
-        "op_b": lambda x: 2 * x,
-        "op_e": lambda x: 3 * x,
+        "op_b": double,
+        "op_e": triple,
         "op_f": lambda x, y, z: x + y + z,
         "a": 5,
         "d": 4,
@@ -288,12 +436,8 @@ def test_multiple_conditional_with_default():
     assert g["result"] == 4
 
 
-def test_edit_step():
-    g = gr.Graph()
-    g.add_step("b", "op_b", "a")
-    g.add_step("c", "op_c", "b")
-    g.set_internal_context({"a": 1, "op_b": lambda x: 2 * x, "op_c": lambda x: 3 * x})
-    g.finalize_definition()
+def test_edit_step(chain_graph):
+    g = chain_graph
 
     g.execute_to_targets("c")
     assert g["b"] == 2
@@ -304,7 +448,7 @@ def test_edit_step():
     assert g["c"] == 6  # Value is unchanged
 
     g.clear_values("b", "c")
-    g.update_internal_context({"d": 3, "new_op_b": lambda x, y: x + y})
+    g.update_internal_context({"d": 3, "new_op_b": add})
     g.finalize_definition()
 
     g.execute_to_targets("c")
@@ -312,17 +456,26 @@ def test_edit_step():
     assert g["c"] == 12
 
 
-def test_remove_step():
-    g = gr.Graph()
-    g.add_step("b", "op_b", "a")
-    g.add_step("c", "op_c", "b")
-    g.set_internal_context({"a": 1, "op_b": lambda x: 2 * x, "op_c": lambda x: 3 * x})
-    g.finalize_definition()
+def test_edit_step_without_changes(chain_graph):
+    g = chain_graph
+    plan = g._plan
+
+    g.edit_step("b", "op_b", "a")
+    assert g._plan is plan
+    assert g.get_args("b") == ("a",)
+
+    g.edit_step("b", "op_b", "a", exponent="d")
+    assert g._plan is None
+    assert g.get_kwargs("b") == {"exponent": "d"}
+
+
+def test_remove_step(chain_graph):
+    g = chain_graph
 
     g.remove_step("b")
     with pytest.raises(KeyError):
         g["b"]
-    with pytest.raises(ValueError):
+    with pytest.raises(ValueError, match="Cannot remove non-existent node d"):
         g.remove_step("d")
 
 
@@ -359,24 +512,47 @@ def test_add_step_quick():
         g.add_step_quick("h", "a non-function object")
 
 
+def test_add_step_quick_does_not_keep_recipes_alive():
+    def example_function(a):
+        return a
+
+    reference = weakref.ref(example_function)
+    g = gr.Graph()
+    g.add_step_quick("b", example_function)
+    g.add_step_quick("c", example_function)
+    del g, example_function
+    gc.collect()
+    # Cached argspecs do not hold strong references to the recipes
+    assert reference() is None
+
+
 def test_topological_generations():
     g = gr.Graph()
     g.add_step("d", "fd", "b", "c")
     g.add_step("b", "fb", "a")
     g.finalize_definition()
 
-    assert g.get_node_attribute("a", "topological_generation_index") == 0
-    assert g.get_node_attribute("b", "topological_generation_index") == 1
-    assert g.get_node_attribute("c", "topological_generation_index") == 0
-    assert g.get_node_attribute("d", "topological_generation_index") == 2
-    assert g.get_node_attribute("fb", "topological_generation_index") == 0
-    assert g.get_node_attribute("fd", "topological_generation_index") == 0
+    assert g.get_node_attributes(
+        ["a", "b", "c", "d", "fb", "fd"], "topological_generation_index"
+    ) == {"a": 0, "b": 1, "c": 0, "d": 2, "fb": 0, "fd": 0}
+
+
+def test_get_dependencies():
+    g = gr.Graph()
+    g.add_step("d", "fd", "b", "a", x="c")
+    g.add_simple_conditional("e", "condition", "d", "a")
+    g.finalize_definition()
+
+    # Dependencies are in the order of the definition
+    assert g.get_dependencies("d") == ["fd", "b", "a", "c"]
+    assert g.get_dependencies("e") == ["condition", "d", "a"]
+    assert g.get_dependencies("a") == []
 
 
 def test_reachability_simple():
     g = gr.Graph()
     g.add_step("b", "fb", "a")
-    g["fb"] = lambda a: a
+    g["fb"] = identity
     g.finalize_definition()
 
     g.find_reachability_targets("b")
@@ -403,6 +579,51 @@ def test_reachability_long_graph():
     assert g.get_reachability("b") == "reachable"
 
 
+def test_clear_reachabilities_with_descendants():
+    g = gr.Graph()
+    g.add_steps(
+        [
+            ("b", "op_b", "a"),
+            ("c", "op_c", "b"),
+            ("e", "op_e", "d"),
+        ]
+    )
+    g.update_internal_context({"op_b": abs, "op_c": abs, "op_e": abs})
+    g.finalize_definition()
+
+    g.find_reachability_targets("c", "e")
+    assert g.get_reachability("c") == "unreachable"
+    assert g.get_reachability("e") == "unreachable"
+
+    # Only the reachabilities that depend on a are cleared
+    g["a"] = 1
+    g.clear_reachabilities("a", include_descendants=True)
+    assert not g.has_reachability("a")
+    assert not g.has_reachability("b")
+    assert not g.has_reachability("c")
+    assert g.has_reachability("e")
+    g.find_reachability_targets("c")
+    assert g.get_reachability("c") == "reachable"
+    assert g.get_reachability("e") == "unreachable"
+
+
+def test_worst_and_best_reachability():
+    g = gr.Graph()
+    g.add_step("a")
+    g.add_step("b")
+    g.add_step("c")
+    g.set_reachability("a", "reachable")
+    g.set_reachability("b", "uncertain")
+    g.set_reachability("c", "unreachable")
+
+    assert g.get_worst_reachability("a", "b") == "uncertain"
+    assert g.get_worst_reachability("a", "b", "c") == "unreachable"
+    assert g.get_best_reachability("b", "c") == "uncertain"
+    assert g.get_best_reachability("a", "b", "c") == "reachable"
+    assert g.get_worst_reachability() == "reachable"
+    assert g.get_best_reachability() == "unreachable"
+
+
 def test_reachability_conditional_with_true_value():
     g = gr.Graph()
     g.add_simple_conditional("name", "condition", "value_true", "value_false")
@@ -501,9 +722,13 @@ def test_multiple_conditional_no_conditions_defined():
 
 def test_sources_and_sinks():
     g = gr.Graph()
-    g.add_step("c", "op_c", "a", "b")
-    g.add_step("e", "op_e", "d")
-    g.add_step("op_c", "b_op_c", "d_op_c")
+    g.add_steps(
+        [
+            ("c", "op_c", "a", "b"),
+            ("e", "op_e", "d"),
+            ("op_c", "b_op_c", "d_op_c"),
+        ]
+    )
     g.finalize_definition()
 
     assert g.get_all_sources(exclude_recipes=True) == {"a", "b", "d"}
@@ -527,7 +752,7 @@ def test_execute_towards_conditions():
     g.add_step("c2", "identity_recipe", "pre_c2")
     g.add_multiple_conditional("conditional", ["c1", "c2", "c3"], ["v1", "v2", "v3"])
     g["pre_c2"] = True
-    g["identity_recipe"] = lambda x: x
+    g["identity_recipe"] = identity
     g.finalize_definition()
 
     g.execute_towards_conditions("c1", "c2", "c3")
@@ -545,7 +770,7 @@ def test_execute_towards_all_conditions_of_conditional():
     g.add_step("c2", "identity_recipe", "pre_c2")
     g.add_multiple_conditional("conditional", ["c1", "c2", "c3"], ["v1", "v2", "v3"])
     g["pre_c2"] = True
-    g["identity_recipe"] = lambda x: x
+    g["identity_recipe"] = identity
     g.finalize_definition()
 
     g.execute_towards_all_conditions_of_conditional("conditional")
@@ -582,7 +807,7 @@ def test_convert_conditional_to_trivial_step_with_evaluation():
     g.add_multiple_conditional("conditional", ["c1", "c2", "c3"], ["v1", "v2", "v3"])
     g["pre_c2"] = True
     g["pre_v2"] = 2
-    g["identity_recipe"] = lambda x: x
+    g["identity_recipe"] = identity
     g.finalize_definition()
 
     g.convert_conditional_to_trivial_step(
@@ -604,7 +829,7 @@ def test_convert_conditional_to_trivial_step_with_default():
     g.add_multiple_conditional("conditional", ["c"], ["v", "default"])
     g["pre_c"] = False
     g["pre_default"] = 1
-    g["identity_recipe"] = lambda x: x
+    g["identity_recipe"] = identity
     g.finalize_definition()
 
     g.convert_conditional_to_trivial_step(
@@ -626,7 +851,7 @@ def test_convert_conditional_to_trivial_step_without_true_values():
     g.add_multiple_conditional("conditional", ["c1", "c2", "c3"], ["v1", "v2", "v3"])
     g["pre_c2"] = False
     g["pre_v2"] = 2
-    g["identity_recipe"] = lambda x: x
+    g["identity_recipe"] = identity
     g.finalize_definition()
 
     with pytest.raises(ValueError):
@@ -646,6 +871,13 @@ def test_get_all_conditionals():
 
     assert g.get_all_conditionals() == {"conditional1", "conditional2"}
 
+    g.remove_step("conditional2")
+    assert g.get_all_conditionals() == {"conditional1"}
+
+    g["c1"] = True
+    g.convert_conditional_to_trivial_step("conditional1")
+    assert g.get_all_conditionals() == set()
+
 
 def test_convert_all_conditionals_to_trivial_steps():
     """
@@ -675,13 +907,17 @@ def test_convert_all_conditionals_to_trivial_steps_with_evaluation():
     """
     g = gr.Graph()
     g.add_multiple_conditional("conditional", ["c1", "c2", "c3"], ["v1", "v2", "v3"])
-    g.add_step("c1", "op_id", "pre_c1")
-    g.add_step("c2", "op_id", "pre_c2")
-    g.add_step("c3", "op_id", "pre_c3")
+    g.add_steps(
+        [
+            ("c1", "op_id", "pre_c1"),
+            ("c2", "op_id", "pre_c2"),
+            ("c3", "op_id", "pre_c3"),
+        ]
+    )
     g["pre_c1"] = True
     g["pre_c2"] = False
     g["pre_c3"] = False
-    g["op_id"] = lambda x: x
+    g["op_id"] = identity
     g["v1"] = 1
     g["v2"] = 2
     g["v3"] = 3
@@ -696,23 +932,31 @@ def test_convert_all_conditionals_to_trivial_steps_with_evaluation():
 
 def test_get_subgraph():
     g = gr.Graph()
-    g.add_step("e", "op_e", "a", "b")
-    g.add_step("f", "op_f", "c", "d")
-    g.add_step("g", "op_g", "e", "f")
+    g.add_steps(
+        [
+            ("e", "op_e", "a", "b"),
+            ("f", "op_f", "c", "d"),
+            ("g", "op_g", "e", "f"),
+        ]
+    )
     g.finalize_definition()
 
     h = g.get_subgraph({"g", "e", "f", "op_g"})
-    h.set_internal_context({"e": 1, "f": 2, "op_g": lambda x, y: x + y})
+    h.set_internal_context({"e": 1, "f": 2, "op_g": add})
     h.execute_to_targets("g")
     assert h["g"] == 3
 
 
 def test_get_all_ancestors():
     g = gr.Graph()
-    g.add_step("e", "op_e", "a", "b")
-    g.add_step("f", "op_f", "c", "d")
-    g.add_step("g", "op_g", "e", "f")
-    g.add_step("h", "op_h", "e")
+    g.add_steps(
+        [
+            ("e", "op_e", "a", "b"),
+            ("f", "op_f", "c", "d"),
+            ("g", "op_g", "e", "f"),
+            ("h", "op_h", "e"),
+        ]
+    )
     g.add_simple_conditional("j", "i", "g", "h")
     g.finalize_definition()
 
@@ -739,12 +983,48 @@ def test_get_all_ancestors():
     }
 
 
+def test_get_all_ancestors_is_lazy():
+    g = gr.Graph()
+    g.add_steps([("c", "op_c", "a", "b"), ("e", "op_e", "d")])
+    g.finalize_definition()
+
+    # Only the queried node and its ancestors are visited
+    assert g.get_all_ancestors_target("c") == {"op_c", "a", "b"}
+    assert set(g._ancestor_masks) == {"c", "op_c", "a", "b"}
+    assert g.get_all_ancestors_target("e") == {"op_e", "d"}
+    assert set(g._ancestor_masks) == {"c", "op_c", "a", "b", "e", "op_e", "d"}
+
+
+def test_get_all_ancestors_after_structural_changes():
+    g = gr.Graph()
+    g.add_step("c", "op_c", "a", "b")
+    g.finalize_definition()
+    assert g.get_all_ancestors_target("c") == {"op_c", "a", "b"}
+
+    # Results are copies, so modifying them does not affect later queries
+    g.get_all_ancestors_target("c").add("z")
+    assert g.get_all_ancestors_target("c") == {"op_c", "a", "b"}
+
+    g.edit_step("c", "op_c", "a", "d")
+    assert g.get_all_ancestors_target("c") == {"op_c", "a", "d"}
+
+    g.add_step("a", "op_a", "x")
+    assert g.get_all_ancestors_target("c") == {"op_c", "a", "op_a", "x", "d"}
+
+    g.remove_step("d")
+    assert g.get_all_ancestors_target("c") == {"op_c", "a", "op_a", "x"}
+
+
 def test_get_path_to_target():
     g = gr.Graph()
-    g.add_step("e", "op_e", "a", "b")
-    g.add_step("f", "op_f", "c", "d")
-    g.add_step("g", "op_g", "e", "f")
-    g.add_step("h", "op_h", "e")
+    g.add_steps(
+        [
+            ("e", "op_e", "a", "b"),
+            ("f", "op_f", "c", "d"),
+            ("g", "op_g", "e", "f"),
+            ("h", "op_h", "e"),
+        ]
+    )
     g.add_simple_conditional("j", "i", "g", "h")
     g.add_simple_conditional("l", "k", "g", "h")
     g.finalize_definition()
@@ -763,6 +1043,28 @@ def test_get_path_to_target():
     assert result_l == {"l", "k", "g", "op_g", "e", "f", "h", "op_h"}
 
 
+def test_get_path_to_target_with_shared_dependencies():
+    # Each layer depends on both nodes of the previous one, so there are 2**depth paths to the top
+    depth = 40
+    g = gr.Graph()
+    for layer in range(1, depth + 1):
+        for side in ("l", "r"):
+            g.add_step(
+                side + str(layer),
+                "op",
+                "l" + str(layer - 1),
+                "r" + str(layer - 1),
+            )
+    g.finalize_definition()
+
+    assert len(g.get_path_to_target("l" + str(depth))) == 2 * depth + 2
+
+    g.update_internal_context({"l30": 0, "r30": 0})
+    assert g.get_path_to_target("l" + str(depth)) == {
+        side + str(layer) for layer in range(30, depth + 1) for side in ("l", "r")
+    } - {"r" + str(depth)} | {"op"}
+
+
 def test_make_recipe_dependencies_also_recipes():
     g = gr.Graph()
     g.add_step("a", "op_a", "b")
@@ -772,3 +1074,418 @@ def test_make_recipe_dependencies_also_recipes():
 
     assert g.is_recipe("d")
     assert not g.is_recipe("c")
+
+
+def test_topological_order_follows_edits(chain_graph):
+    g = chain_graph
+
+    order = g.get_topological_order()
+    assert order.index("a") < order.index("b") < order.index("c")
+
+    # Editing the structure must be reflected in the order
+    g.edit_step("b", "op_b", "d")
+    g.finalize_definition()
+
+    order = g.get_topological_order()
+    assert "d" in order
+    assert order.index("d") < order.index("b") < order.index("c")
+    assert g.get_topological_generation_index("d") == 0
+
+
+def test_equality_after_structural_changes():
+    g = gr.Graph()
+    g.add_step("c", "op_c", "a", "b")
+    h = gr.Graph()
+    h.add_step("c", "op_c", "a", "b")
+    assert g == h
+
+    # Adding a step changes the structure
+    h.add_step("e", "op_e", "c", "d")
+    assert g != h
+
+    # Removing it restores equality
+    h.remove_step("e")
+    h.remove_step("op_e")
+    h.remove_step("d")
+    assert g == h
+
+
+def test_conditional_does_not_compute_untaken_branch():
+    calls = []
+
+    def op_b(x):
+        calls.append("b")
+        return x + 1
+
+    def op_c(x):
+        calls.append("c")
+        return x - 1
+
+    g = gr.Graph()
+    g.add_step("b", "op_b", "a")
+    g.add_step("c", "op_c", "a")
+    g.add_simple_conditional("d", "condition", "b", "c")
+    g["op_b"] = op_b
+    g["op_c"] = op_c
+    g.finalize_definition()
+
+    g["a"] = 1
+    g["condition"] = True
+    g.execute_to_targets("d")
+    assert g["d"] == 2
+    assert calls == ["b"]
+    assert not g.has_value("c")
+
+
+def test_multiple_conditional_does_not_compute_later_conditions():
+    calls = []
+
+    def record(name):
+        def recipe(x):
+            calls.append(name)
+            return x
+
+        return recipe
+
+    g = gr.Graph()
+    for name in ["condition_1", "condition_2", "node_1", "node_2", "node_3"]:
+        g.add_step(name, "op_" + name, "a")
+        g["op_" + name] = record(name)
+    g.add_multiple_conditional(
+        "result", ["condition_1", "condition_2"], ["node_1", "node_2", "node_3"]
+    )
+    g.finalize_definition()
+
+    g["a"] = 1
+    g.execute_to_targets("result")
+    assert g["result"] == 1
+    assert calls == ["condition_1", "node_1"]
+
+    calls.clear()
+    g.clear_values()
+    g["a"] = 0
+    g.execute_to_targets_concurrently("result")
+    assert g["result"] == 0
+    assert calls == ["condition_1", "condition_2", "node_3"]
+
+
+def test_pickle_finalized_graph():
+    g = gr.Graph()
+    g.add_step("c", "op_c", "a", "b")
+    g["op_c"] = operator.add
+    g.finalize_definition()
+
+    h = pickle.loads(pickle.dumps(g))
+    h.update_internal_context({"a": 1, "b": 2})
+    h.execute_to_targets("c")
+    assert h["c"] == 3
+
+
+def test_recipe_can_be_replaced_after_evaluation():
+    g = gr.Graph()
+    g.add_step("c", "op_c", "a", "b")
+    g.update_internal_context({"a": 1, "b": 2})
+    g["op_c"] = operator.add
+    g.execute_to_targets("c")
+    assert g["c"] == 3
+
+    g["op_c"] = operator.mul
+    g.clear_values("c")
+    g.execute_to_targets("c")
+    assert g["c"] == 2
+
+    g.update_internal_context({"op_c": operator.sub, "unknown": 0})
+    g.clear_values("c")
+    g.execute_to_targets("c")
+    assert g["c"] == -1
+    assert "unknown" not in g.nodes
+
+
+def test_add_steps():
+    exp = gr.Graph()
+    exp.add_step("e", "op_e", "a", "b")
+    exp.add_step("f", "op_f", "c", exponent="d")
+    exp.add_step("g")
+
+    g = gr.Graph()
+    g.add_steps(
+        [("e", "op_e", "a", "b"), ("f", "op_f", "c", {"exponent": "d"}), ("g",)]
+    )
+
+    assert g == exp
+
+
+def test_progress_towards_targets_does_not_retry_failures():
+    calls = []
+
+    def op_b(x):
+        calls.append("b")
+        raise ValueError("Cannot compute b")
+
+    g = gr.Graph()
+    g.add_steps(
+        [
+            ("b", "op_b", "a"),
+            ("c", "op_c", "b"),
+            ("d", "op_d", "b"),
+        ]
+    )
+    g.update_internal_context(
+        {"a": 1, "op_b": op_b, "op_c": operator.neg, "op_d": operator.neg}
+    )
+    g.finalize_definition()
+
+    g.progress_towards_targets("c", "d")
+    assert calls == ["b"]
+    assert not g.has_value("c")
+    assert not g.has_value("d")
+
+
+def test_execute_long_chain():
+    length = 3 * sys.getrecursionlimit()
+    g = gr.Graph()
+    for index in range(1, length):
+        g.add_step("n" + str(index), "op", "n" + str(index - 1))
+    g.update_internal_context({"n0": 0, "op": operator.neg})
+    g.finalize_definition()
+
+    g.execute_to_targets("n" + str(length - 1))
+    assert g["n" + str(length - 1)] == 0
+
+    g.clear_values("n" + str(length - 1))
+    g.progress_towards_targets("n" + str(length - 1))
+    assert g["n" + str(length - 1)] == 0
+
+
+def test_reachability_long_chain():
+    length = 3 * sys.getrecursionlimit()
+    g = gr.Graph()
+    for index in range(1, length):
+        g.add_step("n" + str(index), "op", "n" + str(index - 1))
+    g.finalize_definition()
+
+    g.find_reachability_targets("n" + str(length - 1))
+    assert g.get_reachability("n" + str(length - 1)) == "unreachable"
+    g.clear_reachabilities()
+
+    g.update_internal_context({"n0": 0, "op": operator.neg})
+    g.find_reachability_targets("n" + str(length - 1))
+    assert g.get_reachability("n" + str(length - 1)) == "reachable"
+
+
+def test_copies_share_frozen_plan():
+    g = gr.Graph()
+    g.add_step("c", "op_c", "a", "b")
+    g.finalize_definition()
+
+    h = copy.deepcopy(g)
+    assert h._plan is g._plan
+
+    # Changing the structure of the copy does not affect the original
+    h.add_step("e", "op_e", "c", "d")
+    assert h._plan is None
+    assert g.get_topological_order() == list(g._plan.order)
+    assert "e" not in g.get_topological_order()
+
+
+def test_copy(chain_graph):
+    g = chain_graph
+    g.add_step("x")
+    g["x"] = []
+    g.finalize_definition()
+    h = g.copy()
+    assert h == g
+    assert h._plan is not None
+    assert h._plan is g._plan
+
+    # Values and structure are independent, but value objects are shared
+    h.execute_to_targets("c")
+    assert h["c"] == 6
+    assert not g.has_value("c")
+    h.add_step("d", "op_d", "c")
+    assert "d" not in g.nodes
+    h.simplify_dependency("c", "b")
+    assert g.get_args("c") == ("b",)
+    assert g.get_kwargs("c") == {}
+    assert h["x"] is g["x"]
+
+
+def test_finalize_definition_is_idempotent():
+    g = gr.Graph()
+    g.add_step("c", "op_c", "a", "b")
+    g.finalize_definition()
+    plan = g._plan
+
+    # Finalizing again without structural changes reuses the plan, but still freezes new values
+    g["a"] = 1
+    g.finalize_definition()
+    assert g._plan is plan
+    assert g.is_frozen("a")
+
+    # Structural changes are picked up by the next finalization
+    g.add_step("d", "op_d", "c")
+    g.finalize_definition()
+    assert g._plan is not plan
+    assert g.get_topological_generation_index("d") == 2
+
+
+def test_clear_values_with_descendants():
+    calls = []
+
+    def op_d(x):
+        calls.append("d")
+        return -x
+
+    g = gr.Graph()
+    g.add_steps(
+        [
+            ("c", "op_c", "a", "b"),
+            ("d", "op_d", "b"),
+            ("e", "op_e", "c", "d"),
+        ]
+    )
+    g.update_internal_context(
+        {"op_c": operator.add, "op_d": op_d, "op_e": operator.mul}
+    )
+    g.finalize_definition()
+
+    g.update_internal_context({"a": 1, "b": 2})
+    g.execute_to_targets("e")
+    assert g["e"] == -6
+
+    # Changing a only requires recomputing c and e
+    g.clear_values("a", include_descendants=True)
+    g["a"] = 3
+    assert g.has_value("d")
+    assert not g.has_value("c")
+    assert not g.has_value("e")
+    g.execute_to_targets("e")
+    assert g["e"] == -10
+    assert calls == ["d"]
+
+
+def test_topological_order_with_cycle():
+    g = gr.Graph()
+    g.add_step("b", "op_b", "a")
+    g.add_step("a", "op_a", "b")
+
+    with pytest.raises(nx.NetworkXUnfeasible):
+        g.get_topological_order()
+
+
+def test_execute_to_targets_concurrently():
+    # c and d can only be computed if they run at the same time
+    barrier = threading.Barrier(2, timeout=5)
+
+    def op_c(x):
+        barrier.wait()
+        return 2 * x
+
+    def op_d(x):
+        barrier.wait()
+        return 3 * x
+
+    g = gr.Graph()
+    g.add_steps(
+        [
+            ("b", "op_b", "a"),
+            ("c", "op_c", "b"),
+            ("d", "op_d", "b"),
+            ("e", "op_e", "c", "d"),
+        ]
+    )
+    g.update_internal_context(
+        {"a": 1, "op_b": operator.neg, "op_c": op_c, "op_d": op_d, "op_e": operator.sub}
+    )
+    g.finalize_definition()
+
+    g.execute_to_targets_concurrently("e", max_workers=2)
+    assert g["e"] == 1
+
+
+def test_execute_to_targets_concurrently_with_executor():
+    g = gr.Graph()
+    g.add_step("b", "op_b", "a")
+    g.add_step("c", "op_c", "b")
+    g.update_internal_context({"op_b": operator.neg, "op_c": operator.neg})
+    g.finalize_definition()
+
+    # The same executor can serve multiple calls, because it is not shut down
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        for a in range(3):
+            g.clear_values("a", "b", "c")
+            g["a"] = a
+            g.execute_to_targets_concurrently("c", executor=executor)
+            assert g["c"] == a
+        # The number of workers of a given executor cannot be overridden
+        with pytest.raises(ValueError):
+            g.execute_to_targets_concurrently("c", max_workers=2, executor=executor)
+
+
+def test_execute_to_targets_concurrently_with_conditional():
+    calls = []
+
+    def op_b(x):
+        calls.append("b")
+        return x + 1
+
+    g = gr.Graph()
+    g.add_steps(
+        [
+            ("b", "op_b", "a"),
+            ("c", "op_c", "a"),
+            ("condition", "op_condition", "a"),
+        ]
+    )
+    g.add_simple_conditional("d", "condition", "b", "c")
+    g.update_internal_context(
+        {"a": 1, "op_b": op_b, "op_c": operator.neg, "op_condition": operator.not_}
+    )
+    g.finalize_definition()
+
+    g.execute_to_targets_concurrently("d")
+    assert g["d"] == -1
+    assert calls == []
+
+    # Errors are reported as in execute_to_targets
+    g.clear_values()
+    g["op_c"] = 1
+    with pytest.raises(TypeError, match="While evaluating c"):
+        g.execute_to_targets_concurrently("d")
+
+
+def test_equality_depends_on_values():
+    g = gr.Graph()
+    g.add_step("c", "op_c", "a", "b")
+    h = copy.deepcopy(g)
+    assert g == h
+
+    h["a"] = 1
+    assert g != h
+    g["a"] = 2
+    assert g != h
+    g["a"] = 1
+    assert g == h
+
+
+def test_topological_generations_after_remove_step():
+    g = gr.Graph()
+    g.add_steps(
+        [
+            ("b", "op_b", "a"),
+            ("c", "op_c", "b"),
+            ("d", "op_d", "c", "e"),
+        ]
+    )
+    g.finalize_definition()
+
+    g.remove_step("b")
+    g.finalize_definition()
+
+    expected = [set(generation) for generation in nx.topological_generations(g._nxdg)]
+    assert [
+        set(generation) for generation in g.get_topological_generations()
+    ] == expected
+    assert g.get_topological_generation_index("c") == 1
+    assert g.get_topological_generation_index("d") == 2
+    assert g.get_all_sinks() == {"a", "op_b", "d"}
@@ -1,64 +1,101 @@
 """
 Tests of visualization.
 
-In many tests, the source of a graphviz graph is compared to an expected value stored in a pickle (pkl) file.
+In many tests, the source of a graphviz graph is compared to an expected value stored in a json file.
 To build a new test of this kind, simply insert a line like
 expected_sources[name] = gv.string()
 just before the assertion. This populates the expected file with the graph produced by the test.
 After running the test once (with pytest), remove that line, otherwise the test always passes.
-Remember to use LF line endings in the pkl file.
 
 Author: Giulio Foletto <giulio.foletto@outlook.com>.
 License: See project-level license file.
 """
 
-import filecmp
-import pickle
+import json
 
 import pytest
 
 import grapes as gr
 import grapes.visualize  # Needed even if visualize is called as gr.visualize
 
-output_directory = "tests/visualizations"
 expected_directory = "tests/expected"
 
 
+# Module-level recipes, unlike lambdas, can be pickled
+def add(x, y):
+    return x + y
+
+
+def multiply(x, y):
+    return x * y
+
+
+def subtract(x, y):
+    return x - y
+
+
+# Recipes of the graph with e = op_e(a, b), f = op_f(c, d) and g = op_g(e, f), which many tests use
+efg_operations = {"op_e": add, "op_f": multiply, "op_g": subtract}
+
+
 @pytest.fixture(scope="module")
 def expected_sources():
-    with open(expected_directory + "/expected.pkl", "rb") as f:
-        expected = pickle.load(f)
+    with open(expected_directory + "/expected.json", "r") as f:
+        expected = json.load(f)
+    original = dict(expected)
     yield expected
-    with open(expected_directory + "/expected.pkl", "wb") as f:
-        pickle.dump(expected, f, 0)
+    # Only write the file if a test populated it
+    if expected != original:
+        with open(expected_directory + "/expected.json", "w", newline="\n") as f:
+            json.dump(expected, f, indent=4)
+            f.write("\n")
 
 
-def build_graph():
+@pytest.fixture(scope="module")
+def base_graph():
+    """
+    Finalized graph built once per module. Tests must not modify it.
+    """
     g = gr.Graph()
-    g.add_step("e", "op_e", "a", "b")
-    g.add_step("f", "op_f", "c", "d")
-    g.add_step("g", "op_g", "e", "f")
+    g.add_steps(
+        [
+            ("e", "op_e", "a", "b"),
+            ("f", "op_f", "c", "d"),
+            ("g", "op_g", "e", "f"),
+        ]
+    )
     g.finalize_definition()
     return g
 
 
-def test_simple(expected_sources):
-    g = build_graph()
-    name = "simple"
-    gv = gr.visualize.get_graphviz_digraph(g)
+@pytest.mark.parametrize(
+    "name, kwargs",
+    [
+        ("simple", {}),
+        ("attrs", {"rankdir": "LR"}),
+        ("no_operations", {"hide_recipes": True}),
+        ("color_by_generation", {"color_mode": "by_generation", "colormap": "plasma"}),
+        (
+            "color_sources_and_sinks",
+            {"color_mode": "sources_and_sinks", "colormap": "plasma"},
+        ),
+    ],
+)
+def test_options(base_graph, expected_sources, name, kwargs):
+    gv = gr.visualize.get_graphviz_digraph(base_graph, **kwargs)
     assert gv.string() == expected_sources[name]
 
 
-def test_with_values(expected_sources):
-    g = build_graph()
+def test_with_values(base_graph, expected_sources):
+    g = base_graph.copy()
     g.set_internal_context(
         {
             "a": 1,
             "b": 2,
             "f": 12,
-            "op_e": lambda x, y: x + y,
-            "op_f": lambda x, y: x * y,
-            "op_g": lambda x, y: x - y,
+            "op_e": add,
+            "op_f": multiply,
+            "op_g": subtract,
         }
     )
     name = "with_values"
@@ -66,28 +103,17 @@ def test_with_values(expected_sources):
     assert gv.string() == expected_sources[name]
 
 
-def test_attrs(expected_sources):
-    g = build_graph()
-    name = "attrs"
-    gv = gr.visualize.get_graphviz_digraph(g, rankdir="LR")
-    assert gv.string() == expected_sources[name]
-
-
-def test_no_operations(expected_sources):
-    g = build_graph()
-    name = "no_operations"
-    gv = gr.visualize.get_graphviz_digraph(g, hide_recipes=True)
-    assert gv.string() == expected_sources[name]
-
-
-def test_save_dot(expected_sources):
-    g = build_graph()
+def test_save_dot(base_graph, tmp_path):
+    g = base_graph
     name = "simple"
     gv = gr.visualize.get_graphviz_digraph(g)
-    gv.write(output_directory + "/" + name + ".gv")
-    assert filecmp.cmp(
-        output_directory + "/" + name + ".gv", expected_directory + "/" + name + ".gv"
-    )
+    gv.write(str(tmp_path / (name + ".gv")))
+    # The files are small, so comparing their bytes is simpler than filecmp, which would first compare their stats
+    with open(tmp_path / (name + ".gv"), "rb") as f:
+        written = f.read()
+    with open(expected_directory + "/" + name + ".gv", "rb") as f:
+        expected = f.read()
+    assert written == expected
     # Note: as of 2024, dot no longer draws reproducible (to the binary level) pdf files
     # so we are no longer checking for equality of the drawn file
 
@@ -100,14 +126,9 @@ def test_conditional(expected_sources):
     assert gv.string() == expected_sources[name]
 
 
-def test_simplify_dependency(expected_sources):
-    g = build_graph()
-    operations = {
-        "op_e": lambda x, y: x + y,
-        "op_f": lambda x, y: x * y,
-        "op_g": lambda x, y: x - y,
-    }
-    g.set_internal_context(operations)
+def test_simplify_dependency(base_graph, expected_sources):
+    g = base_graph.copy()
+    g.set_internal_context(efg_operations)
 
     name = "presimplification"
     gv = gr.visualize.get_graphviz_digraph(g)
@@ -119,34 +140,11 @@ def test_simplify_dependency(expected_sources):
     assert gv.string() == expected_sources[name]
 
 
-def test_simplify_all_dependencies(expected_sources):
-    g = build_graph()
-    operations = {
-        "op_e": lambda x, y: x + y,
-        "op_f": lambda x, y: x * y,
-        "op_g": lambda x, y: x - y,
-    }
-    g.set_internal_context(operations)
+def test_simplify_all_dependencies(base_graph, expected_sources):
+    g = base_graph.copy()
+    g.set_internal_context(efg_operations)
 
     g.simplify_all_dependencies("g")
     name = "postallsimplification"
     gv = gr.visualize.get_graphviz_digraph(g)
     assert gv.string() == expected_sources[name]
-
-
-def test_color_by_generation(expected_sources):
-    g = build_graph()
-    gv = gr.visualize.get_graphviz_digraph(
-        g, color_mode="by_generation", colormap="plasma"
-    )
-    name = "color_by_generation"
-    assert gv.string() == expected_sources[name]
-
-
-def test_color_sources_and_sinks(expected_sources):
-    g = build_graph()
-    gv = gr.visualize.get_graphviz_digraph(
-        g, color_mode="sources_and_sinks", colormap="plasma"
-    )
-    name = "color_sources_and_sinks"
-    assert gv.string() == expected_sources[name]
@@ -5,15 +5,66 @@ Author: Giulio Foletto <giulio.foletto@outlook.com>.
 License: See project-level license file.
 """
 
+import operator
+import random
 import warnings
 
 import pytest
 
 import grapes as gr
 
+
+# Module-level recipes, unlike lambdas, can be pickled
+def add(x, y):
+    return x + y
+
+
+def multiply(x, y):
+    return x * y
+
+
+def subtract(x, y):
+    return x - y
+
+
+def double(x):
+    return 2 * x
+
+
+def triple(x):
+    return 3 * x
+
+
+def identity(x):
+    return x
+
+
+# Recipes of the graph with e = op_e(a, b), f = op_f(c, d) and g = op_g(e, f), which many tests use
+efg_operations = {"op_e": add, "op_f": multiply, "op_g": subtract}
+
+
 data_directory = "tests/data"
 
 
+@pytest.fixture(scope="module")
+def efg_graph():
+    """
+    Finalized graph with e = op_e(a, b), f = op_f(c, d), g = op_g(e, f) and efg_operations, built once per module.
+    Tests must not modify it, but they can wrap it, since wrapping works on a copy.
+    """
+    g = gr.Graph()
+    g.add_steps(
+        [
+            ("e", "op_e", "a", "b"),
+            ("f", "op_f", "c", "d"),
+            ("g", "op_g", "e", "f"),
+        ]
+    )
+    g.set_internal_context(efg_operations)
+    g.finalize_definition()
+    return g
+
+
 def test_simple_execution():
     g = gr.Graph()
     g.add_step("a")
@@ -23,9 +74,13 @@ def test_simple_execution():
     g.add_step("op_e")
     g.add_step("op_f")
     g.add_step("op_g")
-    g.add_step("e", "op_e", "a", "b")
-    g.add_step("f", "op_f", "c", "d")
-    g.add_step("g", "op_g", "e", "f")
+    g.add_steps(
+        [
+            ("e", "op_e", "a", "b"),
+            ("f", "op_f", "c", "d"),
+            ("g", "op_g", "e", "f"),
+        ]
+    )
     g.finalize_definition()
 
     res = gr.execute_graph_from_context(
@@ -34,9 +89,9 @@ def test_simple_execution():
             "a": 1,
             "b": 2,
             "f": 12,
-            "op_e": lambda x, y: x + y,
-            "op_f": lambda x, y: x * y,
-            "op_g": lambda x, y: x - y,
+            "op_e": add,
+            "op_f": multiply,
+            "op_g": subtract,
         },
         "g",
     )
@@ -48,8 +103,8 @@ def test_execution_more_targets():
     g = gr.Graph()
     g.add_step("c", "op_c", "a", "b")
     g.add_step("f", "op_f", "d", "e")
-    g["op_c"] = lambda a, b: a + b
-    g["op_f"] = lambda d, e: d * e
+    g["op_c"] = add
+    g["op_f"] = multiply
     g.finalize_definition()
 
     res = gr.execute_graph_from_context(g, {"a": 1, "b": 2, "d": 3, "e": 4}, "c", "f")
@@ -61,7 +116,7 @@ def test_execution_more_targets():
 def test_execution_inplace():
     g = gr.Graph()
     g.add_step("c", "op_c", "a", "b")
-    g["op_c"] = lambda a, b: a + b
+    g["op_c"] = add
     g.finalize_definition()
 
     res = gr.execute_graph_from_context(g, {"a": 1, "b": 2}, "c", inplace=True)
@@ -74,7 +129,7 @@ def test_execution_inplace():
 def test_execution_not_inplace_does_not_change_context():
     g = gr.Graph()
     g.add_step("c", "op_c", "a", "b")
-    g["op_c"] = lambda a, b: a + b
+    g["op_c"] = add
     g.finalize_definition()
 
     current_context = g.get_internal_context()
@@ -84,14 +139,16 @@ def test_execution_not_inplace_does_not_change_context():
 
     assert res["c"] == 3
     assert current_context == new_context
+    # The feasibility check does not leave reachabilities on the result
+    assert not any(res.has_reachability(node) for node in res.nodes)
 
 
 def test_execution_of_all_graph():
     g = gr.Graph()
     g.add_step("c", "f_c", "a", "b")
     g.add_step("f", "f_f", "d", "e")
-    g["f_c"] = lambda a, b: a + b
-    g["f_f"] = lambda d, e: d * e
+    g["f_c"] = add
+    g["f_f"] = multiply
     g.finalize_definition()
 
     # No target means that everything is a target
@@ -103,13 +160,13 @@ def test_execution_of_all_graph():
 def test_execution_with_feasibility_check():
     g = gr.Graph()
     g.add_step("b", "fb", "a")
-    g["fb"] = lambda a: a
+    g["fb"] = identity
     g.finalize_definition()
 
     # a is not available
     feasibility, missing_dependencies = gr.check_feasibility_of_execution(g, {}, "b")
     assert feasibility == "unreachable"
-    assert missing_dependencies == set("a")
+    assert missing_dependencies == {"a"}
     with pytest.raises(ValueError):
         gr.execute_graph_from_context(g, {}, "b")
     # Now a becomes available
@@ -133,9 +190,7 @@ def test_execution_with_feasibility_check_uncertain():
     # Reachability is uncertain because condition is reachable and one value also is
     feasibility, missing_dependencies = gr.check_feasibility_of_execution(g, {}, "name")
     assert feasibility == "uncertain"
-    assert missing_dependencies == {
-        "value_false"
-    }  # Note that set("value_false") splits the string into chars
+    assert missing_dependencies == {"value_false"}
     with warnings.catch_warnings(record=True) as w:
         warnings.simplefilter("always")
         res = gr.execute_graph_from_context(g, {}, "name")
@@ -149,7 +204,7 @@ def test_json_from_graph():
     g.add_step("c", "op_c", "a", "b")
     g["a"] = 1
     g["b"] = 2
-    g["op_c"] = lambda a, b: a + b
+    g["op_c"] = add
     g.finalize_definition()
 
     json_string = gr.json_from_graph(g)
@@ -158,98 +213,379 @@ def test_json_from_graph():
     assert json_string == expected_string
 
 
-def test_context_from_json_file():
-    file_name = data_directory + "/example.json"
-    context = gr.context_from_json_file(file_name)
+@pytest.mark.parametrize(
+    "reader, file_name",
+    [
+        (gr.context_from_json_file, "example.json"),
+        (gr.context_from_toml_file, "example.toml"),
+        (gr.context_from_file, "example.json"),
+        (gr.context_from_file, "example.toml"),
+    ],
+)
+def test_context_from_file(reader, file_name):
+    context = reader(data_directory + "/" + file_name)
     expected_context = {"a": 1, "b": 2, "c": "hello"}
 
     assert context == expected_context
 
 
-def test_context_from_toml_file():
-    file_name = data_directory + "/example.toml"
-    context = gr.context_from_toml_file(file_name)
-    expected_context = {"a": 1, "b": 2, "c": "hello"}
-
-    assert context == expected_context
+@pytest.mark.parametrize("input_as_kwargs", [False, True])
+def test_wrap_with_function(efg_graph, input_as_kwargs):
+    g = efg_graph
 
+    # Get a function a,b,c,d -> g
+    f1 = gr.wrap_graph_with_function(
+        g, ["a", "b", "c", "d"], "g", input_as_kwargs=input_as_kwargs
+    )
+    # Get a function a,b,c,d -> [e,f,g]
+    f2 = gr.wrap_graph_with_function(
+        g, ["a", "b", "c", "d"], "e", "f", "g", input_as_kwargs=input_as_kwargs
+    )
+    if input_as_kwargs:
+        assert f1(a=1, b=2, c=3, d=4) == -9
+        assert f2(a=1, b=2, c=3, d=4) == [3, 12, -9]
+    else:
+        assert f1(1, 2, 3, 4) == -9
+        assert f2(1, 2, 3, 4) == [3, 12, -9]
 
-def test_context_from_file():
-    expected_context = {"a": 1, "b": 2, "c": "hello"}
 
-    file_name = data_directory + "/example.json"
-    context = gr.context_from_file(file_name)
-    assert context == expected_context
+def test_wrap_with_function_with_arrays(efg_graph):
+    np = pytest.importorskip("numpy")
+    g = efg_graph
 
-    file_name = data_directory + "/example.toml"
-    context = gr.context_from_file(file_name)
-    assert context == expected_context
+    f = gr.wrap_graph_with_function(g, ["a", "b", "c"], "g", constants={"d": 4})
+    # A single call processes a whole batch
+    a = np.arange(5)
+    c = np.arange(5, 10)
+    np.testing.assert_array_equal(f(a=a, b=2, c=c), a + 2 - c * 4)
 
 
-def test_wrap_with_function():
+def test_wrap_with_function_repeated_calls():
     g = gr.Graph()
     g.add_step("e", "op_e", "a", "b")
-    g.add_step("f", "op_f", "c", "d")
+    g.add_step("f", "op_f", "c", exponent="d")
     g.add_step("g", "op_g", "e", "f")
 
     operations = {
-        "op_e": lambda x, y: x + y,
-        "op_f": lambda x, y: x * y,
-        "op_g": lambda x, y: x - y,
+        "op_e": add,
+        "op_f": lambda x, exponent: x**exponent,
+        "op_g": subtract,
     }
     g.set_internal_context(operations)
     g.finalize_definition()
 
-    # Get a function a,b,c,d -> g
+    f = gr.wrap_graph_with_function(g, ["a", "b", "c"], "g", constants={"d": 2})
+    assert f(a=1, b=2, c=3) == -6
+    assert f(a=4, b=5, c=1) == 8
+    with pytest.raises(TypeError, match="While evaluating e"):
+        f(a=1, b="x", c=3)
+
+
+def test_wrap_with_function_shares_compiled_code():
+    g = gr.Graph()
+    g.add_step("c", "op_c", "a", "b")
+    g.finalize_definition()
+
     f1 = gr.wrap_graph_with_function(
-        g, ["a", "b", "c", "d"], "g", input_as_kwargs=False
+        g, ["a", "b"], "c", constants={"op_c": operator.add}
     )
-    # Get a function a,b,c,d -> [e,f,g]
     f2 = gr.wrap_graph_with_function(
-        g, ["a", "b", "c", "d"], "e", "f", "g", input_as_kwargs=False
+        g, ["a", "b"], "c", constants={"op_c": operator.mul}
     )
-    assert f1(1, 2, 3, 4) == -9
-    assert f2(1, 2, 3, 4) == [3, 12, -9]
+    assert f1(a=2, b=3) == 5
+    assert f2(a=2, b=3) == 6
+    assert f1.__code__ is f2.__code__
 
 
-def test_lambdify():
+def test_wrap_with_function_with_conditional():
+    calls = []
+
+    def op_c(x):
+        calls.append("c")
+        return x + 1
+
+    def op_d(x):
+        calls.append("d")
+        return x - 1
+
     g = gr.Graph()
-    g.add_step("e", "op_e", "a", "b")
-    g.add_step("f", "op_f", "c", "d")
-    g.add_step("g", "op_g", "e", "f")
+    g.add_steps(
+        [
+            ("c", "op_c", "a"),
+            ("d", "op_d", "a"),
+            ("condition", "op_condition", "a"),
+        ]
+    )
+    g.add_simple_conditional("e", "condition", "c", "d")
+    g.add_step("f", "op_f", "e")
+    g.set_internal_context(
+        {"op_c": op_c, "op_d": op_d, "op_condition": bool, "op_f": operator.neg}
+    )
+    g.finalize_definition()
 
-    operations = {
-        "op_e": lambda x, y: x + y,
-        "op_f": lambda x, y: x * y,
-        "op_g": lambda x, y: x - y,
-    }
-    g.set_internal_context(operations)
+    f = gr.wrap_graph_with_function(g, ["a"], "f")
+    # Only the selected possibility is computed
+    assert f(a=1) == -2
+    assert calls == ["c"]
+    assert f(a=0) == 1
+    assert calls == ["c", "d"]
+
+    # As in execute_to_targets, failures of possibilities are reported as such
+    with pytest.raises(ValueError, match="Node c could not be computed"):
+        f(a="x")
+
+
+def test_wrap_with_function_uncertain_repeated_calls():
+    calls = []
+
+    def op_h(x):
+        calls.append("h")
+        return 2 * x
+
+    g = gr.Graph()
+    g.add_steps(
+        [
+            ("h", "op_h", "k"),
+            ("c", "op_c", "a", "h"),
+            ("d", "op_d", "b"),
+        ]
+    )
+    g.add_simple_conditional("e", "a", "c", "d")
+    g.set_internal_context({"op_c": add, "op_h": op_h})
     g.finalize_definition()
 
-    # Get a function a,b,c,d -> g
-    f1 = gr.lambdify_graph(g, ["a", "b", "c", "d"], "g")
-    assert f1(a=1, b=2, c=3, d=4) == -9
+    # The computation cannot be compiled, because d can never be computed
+    with pytest.warns(UserWarning):
+        f = gr.wrap_graph_with_function(g, ["a"], "e", constants={"k": 1})
+    assert f(a=1) == 3
+    assert f(a=2) == 4
+    # Nodes that do not depend on the input are computed only once
+    assert calls == ["h"]
+    with pytest.raises(ValueError):
+        f(a=0)
+    # A failed call does not affect the following ones
+    assert f(a=3) == 5
 
 
-def test_lambdify_with_constants():
+def test_fold_conditional():
     g = gr.Graph()
-    g.add_step("e", "op_e", "a", "b")
-    g.add_step("f", "op_f", "c", "d")
-    g.add_step("g", "op_g", "e", "f")
+    g.add_multiple_conditional(
+        "conditional", ["c1", "c2", "c3"], ["p1", "p2", "p3", "default"]
+    )
+    g.finalize_definition()
+
+    # Nothing is known
+    assert gr.fold_conditional(g, "conditional") == (
+        ["c1", "c2", "c3"],
+        ["p1", "p2", "p3", "default"],
+    )
+    # Conditions known to be false are dropped
+    g["c2"] = False
+    assert gr.fold_conditional(g, "conditional") == (
+        ["c1", "c3"],
+        ["p1", "p3", "default"],
+    )
+    # A condition known to be true ends the conditions, but previous unknown conditions are kept
+    g["c3"] = True
+    assert gr.fold_conditional(g, "conditional") == (["c1"], ["p1", "p3"])
+    # Input is never known
+    assert gr.fold_conditional(g, "conditional", ["c3"]) == (
+        ["c1", "c3"],
+        ["p1", "p3", "default"],
+    )
+    # The conditional is decided when all previous conditions are known
+    g["c1"] = False
+    assert gr.fold_conditional(g, "conditional") == ([], ["p3"])
+
+
+@pytest.mark.parametrize("c2", [True, False])
+def test_wrap_with_function_with_input_condition(c2):
+    g = gr.Graph()
+    g.add_step("c1", "op_c1", "a")
+    g.add_multiple_conditional("r", ["c1", "c2"], ["p1", "p2", "p3"])
+    g.set_internal_context({"op_c1": bool, "p1": "p1", "p2": "p2", "p3": "p3"})
+    g.finalize_definition()
+
+    # As in execute_to_targets, a true input condition is selected before computing the others
+    h = g.copy()
+    h.update_internal_context({"a": 1, "c2": c2})
+    h.execute_to_targets("r")
+    f = gr.wrap_graph_with_function(g, ["a", "c2"], "r")
+    assert f(a=1, c2=c2) == h["r"] == ("p2" if c2 else "p1")
+    assert f(a=0, c2=c2) == ("p2" if c2 else "p3")
 
+
+def test_wrap_with_function_with_chained_conditionals():
+    # Conditionals check first the conditions that already have values, which depends on the order of evaluation
+    g = gr.Graph()
+    g.add_multiple_conditional("n2", ["n0"], ["n1", "n0"])
+    g.add_multiple_conditional("n3", ["n2", "n1"], ["n0", "n1", "n2"])
+    g.finalize_definition()
+
+    for targets in [("n2", "n3"), ("n3", "n2")]:
+        h = g.copy()
+        h.update_internal_context({"n0": 4, "n1": 6})
+        h.execute_to_targets(*targets)
+        f = gr.wrap_graph_with_function(g, ["n0", "n1"], *targets)
+        assert f(n0=4, n1=6) == h.get_list_of_values(targets)
+
+    # A conditional that depends on the input is not fixed by a true constant condition
+    g = gr.Graph()
+    g.add_multiple_conditional("r", ["a", "k"], ["p", "q", "s"])
+    g.set_internal_context({"p": "p", "q": "q", "s": "s"})
+    g.finalize_definition()
+    f = gr.wrap_graph_with_function(g, ["a"], "r", constants={"k": True})
+    assert f(a=True) == "p"
+    assert f(a=False) == "q"
+
+
+def safe_floor_divide(x, y):
+    # Fails for some input, so that the reporting of failures is compared too
+    if isinstance(x, int) and isinstance(y, int) and y == 0:
+        raise ZeroDivisionError("division by zero")
+    return x // y
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_wrap_with_function_matches_execute_to_targets(seed):
+    rng = random.Random(seed)
+    # Sources are the input n0 and n1 and the constant n2, the other nodes are random steps and conditionals of previous nodes
+    g = gr.Graph()
     operations = {
-        "op_e": lambda x, y: x + y,
-        "op_f": lambda x, y: x * y,
-        "op_g": lambda x, y: x - y,
+        "op_add": add,
+        "op_subtract": subtract,
+        "op_divide": safe_floor_divide,
     }
+    nodes = ["n0", "n1", "n2"]
+    for node in nodes:
+        g.add_step(node)
+    for index in range(3, rng.randint(6, 14)):
+        name = "n" + str(index)
+        if rng.random() < 0.5:
+            g.add_step(name, rng.choice(list(operations)), *rng.sample(nodes, 2))
+        else:
+            number_of_conditions = rng.randint(1, min(3, len(nodes) - 1))
+            g.add_multiple_conditional(
+                name,
+                rng.sample(nodes, number_of_conditions),
+                rng.sample(nodes, number_of_conditions + 1),
+            )
+        nodes.append(name)
     g.set_internal_context(operations)
     g.finalize_definition()
 
+    def run(function):
+        try:
+            return function()
+        except Exception as e:
+            return type(e), str(e)
+
+    # Conditionals are also conditions of later conditionals, and targets are requested in both orders
+    targets = rng.sample(nodes[3:], 2)
+    for targets in [targets, targets[::-1]]:
+        for constant in [0, 1, 3]:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                f = gr.wrap_graph_with_function(
+                    g, ["n0", "n1"], *targets, constants={"n2": constant}
+                )
+            for n0, n1 in [(0, 0), (4, 6), (-1, 2), (5, 0), (1, 1)]:
+                h = g.copy()
+                h.update_internal_context({"n0": n0, "n1": n1, "n2": constant})
+                expected = run(
+                    lambda: (
+                        h.execute_to_targets(*targets),
+                        h.get_list_of_values(targets),
+                    )[1]
+                )
+                assert run(lambda: f(n0=n0, n1=n1)) == expected
+
+
+def test_wrap_with_function_with_constant_condition():
+    g = gr.Graph()
+    g.add_step("c", "op_c", "a")
+    g.add_step("d", "op_d", "b")
+    g.add_simple_conditional("e", "condition", "c", "d")
+    g.set_internal_context({"op_c": operator.neg})
+    g.finalize_definition()
+
+    # Possibility d cannot be computed, but it is never selected
+    f = gr.wrap_graph_with_function(g, ["a"], "e", constants={"condition": True})
+    assert f(a=1) == -1
+    assert f(a=2) == -2
+
+
+def test_lambdify(efg_graph):
+    g = efg_graph
+
+    # Get a function a,b,c,d -> g
+    f1 = gr.lambdify_graph(g, ["a", "b", "c", "d"], "g")
+    assert f1(a=1, b=2, c=3, d=4) == -9
+    # The function is built once and can be called many times
+    assert f1(a=0, b=0, c=1, d=1) == -1
+    assert f1(a=1, b=2, c=3, d=4) == -9
+    # Lambdifying the same computation again reuses the compiled code
+    f2 = gr.lambdify_graph(g, ["a", "b", "c", "d"], "g")
+    assert f2.__code__ is f1.__code__
+
+
+def test_lambdify_with_constants(efg_graph):
+    g = efg_graph
+
     # Get a function a,b,c,d -> g
     f1 = gr.lambdify_graph(g, ["c", "d"], "g", {"a": 1, "b": 2})
     assert f1(c=3, d=4) == -9
 
 
+@pytest.mark.parametrize(
+    "wrapper",
+    [
+        lambda g, constants: gr.lambdify_graph(g, ["c", "d"], "g", constants),
+        lambda g, constants: gr.wrap_graph_with_function(
+            g, ["c", "d"], "g", constants=constants
+        ),
+    ],
+    ids=["lambdify", "wrap"],
+)
+def test_constant_subcomputations_are_evaluated_once(wrapper):
+    calls = []
+
+    def op_e(x, y):
+        calls.append("e")
+        return x + y
+
+    g = gr.Graph()
+    g.add_steps(
+        [
+            ("e", "op_e", "a", "b"),
+            ("f", "op_f", "c", "d"),
+            ("g", "op_g", "e", "f"),
+        ]
+    )
+    g.set_internal_context({"op_e": op_e, "op_f": multiply, "op_g": subtract})
+    g.finalize_definition()
+
+    # e only depends on constants, so it is evaluated when the function is built, not when it is called
+    f = wrapper(g, {"a": 1, "b": 2})
+    assert calls == ["e"]
+    assert f(c=3, d=4) == -9
+    assert f(c=1, d=1) == 2
+    assert calls == ["e"]
+
+
+def test_lambdify_with_conditional():
+    g = gr.Graph()
+    g.add_step("c", "op_c", "a")
+    g.add_step("d", "op_d", "b")
+    g.add_simple_conditional("e", "condition", "c", "d")
+    g.update_internal_context({"op_c": double, "op_d": triple})
+    g.finalize_definition()
+
+    f = gr.lambdify_graph(g, ["a", "b"], "e", {"condition": False})
+    assert f(a=1, b=2) == 6
+    assert f(a=3, b=4) == 12
+
+
 def test_unfeasible_wrap():
     g = gr.Graph()
     g.add_step("d", "op_d", "a", "b", "c")
@@ -270,25 +606,24 @@ def test_unfeasible_wrap():
 
 def test_get_execution_subgraph():
     g = gr.Graph()
-    g.add_step("e", "op_e", "a", "b")
-    g.add_step("f", "op_f", "c", "d")
-    g.add_step("g", "op_g", "e", "f")
-    g.add_step("h", "op_h", "e")
+    g.add_steps(
+        [
+            ("e", "op_e", "a", "b"),
+            ("f", "op_f", "c", "d"),
+            ("g", "op_g", "e", "f"),
+            ("h", "op_h", "e"),
+        ]
+    )
     g.add_simple_conditional("j", "i", "g", "h")
-    g.finalize_definition()
-    operations = {
-        "op_e": lambda x, y: x + y,
-        "op_f": lambda x, y: x * y,
-        "op_g": lambda x, y: x - y,
-        "op_h": lambda x: x,
-    }
-    g.set_internal_context(operations)
+    g.set_internal_context({**efg_operations, "op_h": identity})
     g.finalize_definition()
     context = {"e": 1, "f": 1, "i": True}
 
     h = gr.get_execution_subgraph(g, context, "j", "h")
 
     assert set(h.nodes) == {"j", "i", "g", "h", "op_h", "e", "op_g", "f"}
+    # The original graph is not affected
+    assert not g.has_value("e")
 
     res = gr.execute_graph_from_context(h, context, "j", "h")
     assert res["j"] == 0